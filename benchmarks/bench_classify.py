@@ -0,0 +1,71 @@
+#!/usr/bin/python
+
+# Compares the per-cell and batched column classifiers in schema_generator on
+# samples/data.csv, replicated out to the width and height of a production
+# Census extract. Run from the root of the repository:
+#
+#   python benchmarks/bench_classify.py -w 1000 -r 50000
+
+import argparse
+import csv
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from census_looker import schema as sg  # noqa: E402
+
+
+parser = argparse.ArgumentParser(description='Benchmark column type '
+                                 'classification')
+parser.add_argument('-f', '--file_loc', help='Datafile to replicate',
+                    default=os.path.join(os.path.dirname(__file__), os.pardir,
+                                         'samples', 'data.csv'))
+parser.add_argument('-w', '--width', help='Number of columns to replicate to',
+                    type=int, default=1000)
+parser.add_argument('-r', '--rows', help='Number of rows to replicate to',
+                    type=int, default=50000)
+parser.add_argument('-c', '--chunk_size', help='Rows per chunk', type=int,
+                    default=10000)
+
+
+def replicate(datafile, width, height):
+    with open(datafile, "rb") as csvfile:
+        reader = csv.reader(csvfile)
+        header_row = next(reader)
+        body = list(reader)
+    # Widen each row by repeating its columns, then repeat rows until the
+    # table is tall enough
+    copies = width // len(header_row) + 1
+    body = [(row * copies)[:width] for row in body]
+    return [body[r % len(body)] for r in range(height)]
+
+
+def time_classifier(rows, width, chunk_size, classify):
+    start = time.time()
+    types, scanned = sg.scan_rows(iter(rows), [sg.INTEGER] * width,
+                                  chunk_size, classify)
+    elapsed = time.time() - start
+    return types, scanned * width / elapsed
+
+
+def main():
+    args = parser.parse_args()
+    rows = replicate(args.file_loc, args.width, args.rows)
+    print "{} rows x {} columns".format(len(rows), args.width)
+
+    results = {}
+    for name, classify in (("per-cell", sg.widen_column),
+                           ("batched", sg.classify_column)):
+        results[name] = time_classifier(rows, args.width, args.chunk_size,
+                                        classify)
+        print "{:>9}: {:,.0f} cells/sec".format(name, results[name][1])
+
+    if results["per-cell"][0] != results["batched"][0]:
+        print "WARNING: classifiers disagree on column types"
+    print "Speedup: {:.1f}x".format(results["batched"][1] /
+                                    results["per-cell"][1])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/python
+
+# Benchmarks codebook parsing on large synthetic DataFerrett codebooks and
+# compares it with the original line-by-line regex cascade. Run from the root
+# of the repository:
+#
+#   python benchmarks/bench_codebook.py -q 5000 -k 40
+
+import argparse
+import collections as coll
+import os
+import random
+import re
+import sys
+import time
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from census_looker import codebook as cp  # noqa: E402
+
+
+parser = argparse.ArgumentParser(description='Benchmark codebook parsing')
+parser.add_argument('-q', '--questions', help='Questions per codebook',
+                    type=int, default=5000)
+parser.add_argument('-k', '--keys', help='Average value labels per question',
+                    type=int, default=40)
+parser.add_argument('-s', '--seed', help='Random seed', type=int, default=0)
+parser.add_argument('-y', '--years', help='Number of yearly codebooks to '
+                    'merge', type=int, default=50)
+parser.add_argument('-g', '--growth', help='Questions added each year',
+                    type=int, default=20)
+
+TOPICS = ("Demographic Variables", "Geography Variables",
+          "Earnings Variables", "Labor Force Variables")
+WORDS = ("Not in Universe", "Married", "Spouse Present", "High School",
+         "Grad-Diploma Or Equiv (ged)", "Boston-Worcester, MA-NH",
+         "Bachelor's Degree(ex:ba,ab,bs)", "Yes", "No", "Other")
+
+
+def synthetic_codebook(questions, keys, dataset, seed=0):
+    # Lay out a codebook the way DataFerrett does: a header, then for each
+    # question its topic, name, description and either value labels or a
+    # range. Each question is seeded separately, so codebooks with more or
+    # fewer questions agree on the questions they share, like yearly
+    # releases of a survey.
+    lines = ["DataFerrett Codebook - Created \n", "\n", "\n",
+             "Dataset: {}\n".format(dataset)]
+    for q in range(questions):
+        rng = random.Random(seed * 1000003 + q)
+        topic = rng.choice(TOPICS)
+        lines.append("Topic: {}\n".format(topic))
+        lines.append("Q{:07d}\n".format(q))
+        lines.append("{}-synthetic question {}\n".format(topic.split()[0], q))
+        lines.append("\n")
+        lines.append("With the following Ranges:\n")
+        if rng.random() < 0.1:
+            lines.append("0:{}  Range\n".format(rng.randint(10, 3000)))
+        else:
+            lines.append("-1  Not in Universe\n")
+            for k in range(rng.randint(1, 2 * keys)):
+                lines.append("{}  {} {}\n".format(k, rng.choice(WORDS), k))
+        lines.extend(["\n", "\n", "\n"])
+    return "".join(lines)
+
+
+# The parser as it was before the combined tokenizer, kept here as the
+# baseline to measure against
+def legacy_parse(cb, tb):
+    lines = cb.readlines()
+    i = 0
+    parsed_cb = coll.OrderedDict()
+    dataset_re = re.compile(r'^Dataset: .*')
+    topic_cap_re = re.compile(r'^Topic: ([A-z ]*)')
+    q_name_cap_re = re.compile(r'(^[A-Z\d]{1,8})$')
+    q_description_cap_re = re.compile(r'-(?!\s)([\w\d\W\s]*$)')
+    new_q_description_cap_re = re.compile(r'(?:\s-\s)?([\w\d\W\s]*$)')
+    key_val_re = re.compile(r'^-?[0-9]* {2}[A-z 0-9\W]*$')
+    val_range_cap_re = re.compile(
+        r'(^-?[0-9.]+:-?[0-9.]+)  (?:Hours|Range|Year|# of own children '
+        'under 18 years of age|Specific City Code|Line number|persons)$')
+    whitespace_re = re.compile(r'^\s*$')
+    key_cap_re = re.compile(r'(^-?[0-9]*)')
+    value_cap_re = re.compile(r'^-?[0-9]* {2}([A-z 0-9\W]*$)')
+    weird_lines = tuple(cp.weird_lines)
+    ignorable = tuple(cp.ignorable)
+    q_id_line = 0
+    for line in lines:
+        i += 1
+        if re.match(dataset_re, line):
+            parsed_cb[tb] = coll.OrderedDict()
+            q_id_line = 0
+        elif re.match(topic_cap_re, line):
+            topic = re.findall(topic_cap_re, line)[0]
+            q_id_line = 0
+        elif re.match(q_name_cap_re, line):
+            q_name = re.findall(q_name_cap_re, line)[0]
+            if q_name not in parsed_cb[tb]:
+                parsed_cb[tb][q_name] = coll.OrderedDict()
+                parsed_cb[tb][q_name]["Topic"] = topic
+                parsed_cb[tb][q_name]["Source"] = [tb]
+                q_id_line = 1
+        elif re.match(key_val_re, line):
+            if "Keys" not in parsed_cb[tb][q_name]:
+                parsed_cb[tb][q_name]["Keys"] = coll.OrderedDict()
+            key = re.findall(key_cap_re, line)[0]
+            value = re.findall(value_cap_re, line)[0]
+            parsed_cb[tb][q_name]["Keys"][key] = value
+            q_id_line = 0
+        elif re.match(val_range_cap_re, line):
+            value_range = re.findall(val_range_cap_re, line)[0]
+            parsed_cb[tb][q_name]["Range"] = value_range
+            q_id_line = 0
+        elif re.match(q_description_cap_re, line):
+            q_description = re.findall(q_description_cap_re, line)[0]
+            parsed_cb[tb][q_name]["Description"] = q_description
+            q_id_line = 0
+        elif q_id_line:
+            q_description = re.findall(new_q_description_cap_re, line)[0]
+            parsed_cb[tb][q_name]["Description"] = q_description
+            q_id_line = 0
+        elif re.match(whitespace_re, line) or line.rstrip() in set(ignorable):
+            q_id_line = 0
+        elif line.rstrip() in set(weird_lines):
+            parsed_cb[tb][q_name]["Description"] = line
+            q_id_line = 0
+        else:
+            q_id_line = 0
+    return parsed_cb
+
+
+def legacy_merge(to_merge, table_to_merge, final_dict):
+    # The merge as it was before questions were matched by digest, copying
+    # both codebooks without their sources on every call
+    def remove_source(dictionary):
+        sourceless_dict = coll.OrderedDict()
+        for a in dictionary:
+            sourceless_dict[a] = coll.OrderedDict()
+            for b in dictionary[a]:
+                if b != 'Source':
+                    sourceless_dict[a][b] = dictionary[a][b]
+        return sourceless_dict
+
+    tm_sourceless = remove_source(to_merge)
+    fd_sourceless = remove_source(final_dict)
+    for k, v in tm_sourceless.iteritems():
+        if k in fd_sourceless:
+            if v == fd_sourceless[k]:
+                final_dict[k]["Source"].append(table_to_merge)
+            else:
+                raise ValueError("synthetic codebooks should never conflict")
+        else:
+            final_dict[k] = to_merge[k]
+    return final_dict
+
+
+def time_merge(parse, merge, texts):
+    # Parse every yearly codebook up front, then time merging them in order
+    quiet(True)
+    try:
+        parsed = [parse(StringIO(text), "cps_{}".format(year))
+                  for year, text in enumerate(texts)]
+    finally:
+        quiet(False)
+    start = time.time()
+    final = coll.OrderedDict()
+    for year, cb in enumerate(parsed):
+        table = "cps_{}".format(year)
+        final = merge(cb[table], table, final)
+    return final, time.time() - start
+
+
+def as_dicts(parsed_cb):
+    # Convert the current model back to the legacy nested dicts, so the two
+    # parsers' output can be compared
+    legacy = coll.OrderedDict()
+    for dataset, questions in parsed_cb.items():
+        legacy[dataset] = coll.OrderedDict()
+        for name, q in questions.items():
+            d = legacy[dataset][name] = coll.OrderedDict()
+            d["Topic"] = q.topic
+            d["Source"] = q.source
+            if q.description is not None:
+                d["Description"] = q.description
+            if q.codes:
+                d["Keys"] = coll.OrderedDict(zip(q.codes, q.labels))
+            if q.range is not None:
+                d["Range"] = q.range
+    return legacy
+
+
+def deep_size(obj, seen=None):
+    # Total memory held by an object and everything it refers to, counting
+    # shared objects (such as interned strings) once
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen)
+                    for k, v in obj.items())
+        # OrderedDict also keeps a linked list of its keys, one three-item
+        # list per key plus a dict mapping keys to their links
+        if isinstance(obj, coll.OrderedDict):
+            size += sys.getsizeof(obj._OrderedDict__map)
+            size += len(obj) * sys.getsizeof([None] * 3)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(deep_size(getattr(obj, slot), seen)
+                    for slot in obj.__slots__)
+    return size
+
+
+def quiet(on, stdout=[]):
+    # The current parser announces each codebook it parses; keep that out of
+    # the results
+    if on:
+        stdout.append(sys.stdout)
+        sys.stdout = StringIO()
+    else:
+        sys.stdout = stdout.pop()
+
+
+def time_parser(parse, text, table):
+    quiet(True)
+    try:
+        start = time.time()
+        parsed = parse(StringIO(text), table)
+        return parsed, time.time() - start
+    finally:
+        quiet(False)
+
+
+def main():
+    args = parser.parse_args()
+    text = synthetic_codebook(args.questions, args.keys, "CPS//Synthetic",
+                              args.seed)
+    lines = text.count("\n")
+    print "{:,} questions, {:,} lines, {:.1f} MB".format(
+        args.questions, lines, len(text) / 1e6)
+
+    new, new_time = time_parser(cp.parseCodebook, text, "synthetic")
+    old, old_time = time_parser(legacy_parse, text, "synthetic")
+
+    print "  legacy: {:,.0f} lines/sec".format(lines / old_time)
+    print " current: {:,.0f} lines/sec".format(lines / new_time)
+    print "Speedup: {:.1f}x".format(old_time / new_time)
+
+    old_size, new_size = deep_size(old), deep_size(new)
+    print "  legacy: {:.1f} MB in memory".format(old_size / 1e6)
+    print " current: {:.1f} MB in memory ({:.0%} smaller)".format(
+        new_size / 1e6, 1 - float(new_size) / old_size)
+    if old != as_dicts(new):
+        print "WARNING: parsers disagree on the parsed codebook"
+
+    # Merging yearly codebooks, each a little larger than the last
+    texts = [synthetic_codebook(args.questions + year * args.growth,
+                                args.keys, "CPS//Synthetic", args.seed)
+             for year in range(args.years)]
+    print "\nMerging {} yearly codebooks".format(args.years)
+    old, old_time = time_merge(legacy_parse, legacy_merge, texts)
+    new, new_time = time_merge(cp.parseCodebook, cp.dict_merge, texts)
+    print "  legacy: {:.2f}s".format(old_time)
+    print " current: {:.2f}s".format(new_time)
+    print "Speedup: {:.1f}x".format(old_time / new_time)
+    if old != as_dicts({"merged": new})["merged"]:
+        print "WARNING: merges disagree on the merged codebook"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+# Compares streaming type inference over compressed copies of a datafile
+# against the plain, uncompressed path. The datafile is samples/data.csv
+# replicated out to the requested width and height. Run from the root of the
+# repository:
+#
+#   python benchmarks/bench_compressed.py -w 500 -r 50000
+
+import argparse
+import bz2
+import csv
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from census_looker import schema as sg  # noqa: E402
+from bench_classify import replicate  # noqa: E402
+
+
+parser = argparse.ArgumentParser(description='Benchmark type inference over '
+                                 'compressed datafiles')
+parser.add_argument('-f', '--file_loc', help='Datafile to replicate',
+                    default=os.path.join(os.path.dirname(__file__), os.pardir,
+                                         'samples', 'data.csv'))
+parser.add_argument('-w', '--width', help='Number of columns to replicate to',
+                    type=int, default=500)
+parser.add_argument('-r', '--rows', help='Number of rows to replicate to',
+                    type=int, default=50000)
+parser.add_argument('-c', '--chunk_size', help='Rows per chunk', type=int,
+                    default=10000)
+
+
+def write_copies(rows, width, directory):
+    plain = os.path.join(directory, "data.csv")
+    with open(plain, "wb") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["C{}".format(c) for c in range(width)])
+        writer.writerows(rows)
+
+    copies = [("plain", plain)]
+    for name, opener in (("gzip", gzip.GzipFile), ("bz2", bz2.BZ2File)):
+        path = plain + "." + name
+        with open(plain, "rb") as src:
+            dst = opener(path, "wb")
+            shutil.copyfileobj(src, dst)
+            dst.close()
+        copies.append((name, path))
+    path = os.path.join(directory, "data.zip")
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.write(plain, "data.csv")
+    copies.append(("zip", path))
+    return plain, copies
+
+
+def main():
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    try:
+        rows = replicate(args.file_loc, args.width, args.rows)
+        plain, copies = write_copies(rows, args.width, directory)
+        del rows
+        size = os.path.getsize(plain)
+        print "{} rows x {} columns, {:.1f} MB uncompressed".format(
+            args.rows, args.width, size / 1e6)
+
+        baseline = None
+        for name, path in copies:
+            fingerprint = sg.file_fingerprint(path)
+            types = [sg.INTEGER] * len(fingerprint["header_row"])
+            if fingerprint["codec"]:
+                job = (path, types, None, None, args.chunk_size, None)
+            else:
+                start = len(next(open(path, "rb")))
+                job = (path, types, start, size, args.chunk_size, None)
+            began = time.time()
+            sg.scan_range(job)
+            rate = size / (time.time() - began) / 1e6
+            baseline = baseline or rate
+            print "{:>6}: {:6.1f} MB/s of CSV ({:5.1f} MB on disk, " \
+                "{:.2f}x plain)".format(name, rate,
+                                        os.path.getsize(path) / 1e6,
+                                        rate / baseline)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# Compares the size of the LookML written for a large merged codebook, and the
+# time taken to write it, between the sql_case and lookup table layouts. Run
+# from the root of the repository:
+#
+#   python benchmarks/bench_lookml.py -q 3000 -y 10
+
+import argparse
+import collections as coll
+import os
+import shutil
+import sys
+import tempfile
+import time
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from census_looker import codebook as cp  # noqa: E402
+from census_looker import lookml  # noqa: E402
+from bench_codebook import synthetic_codebook, quiet  # noqa: E402
+
+
+parser = argparse.ArgumentParser(description='Benchmark LookML layouts')
+parser.add_argument('-q', '--questions', help='Questions in the first year',
+                    type=int, default=3000)
+parser.add_argument('-k', '--keys', help='Average value labels per question',
+                    type=int, default=40)
+parser.add_argument('-y', '--years', help='Number of yearly codebooks to '
+                    'merge', type=int, default=10)
+parser.add_argument('-g', '--growth', help='Questions added each year',
+                    type=int, default=50)
+
+
+def merged_codebook(questions, keys, years, growth):
+    tables, merged = [], coll.OrderedDict()
+    quiet(True)
+    try:
+        for year in range(years):
+            table = "cps_{}".format(year)
+            text = synthetic_codebook(questions + year * growth, keys,
+                                      "CPS//Synthetic")
+            parsed = cp.parseCodebook(StringIO(text), table)
+            merged = cp.dict_merge(parsed[table], table, merged)
+            tables.append(table)
+    finally:
+        quiet(False)
+    return tables, merged
+
+
+def describe(directory, names):
+    sizes = [os.path.getsize(os.path.join(directory, n)) for n in names]
+    lines = [sum(1 for _ in open(os.path.join(directory, n))) for n in names]
+    return sum(sizes), sum(lines)
+
+
+def average_block(path, marker, keep=lambda block: True):
+    # The average length of the blocks of a file that start with marker,
+    # which stands in for the SQL Looker generates for one dimension
+    blocks = [b for b in open(path).read().split(marker)[1:] if keep(b)]
+    return sum(len(b) for b in blocks) / max(len(blocks), 1)
+
+
+def main():
+    args = parser.parse_args()
+    tables, merged = merged_codebook(args.questions, args.keys, args.years,
+                                     args.growth)
+    print "{:,} questions merged from {} codebooks".format(len(merged),
+                                                           args.years)
+
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        to_print = coll.OrderedDict([("census", merged)])
+        start = time.time()
+        lookml.writebaseLookMLview(to_print, tables)
+        case_time = time.time() - start
+        case_size, case_lines = describe(directory, ["census.view.lookml"])
+        case_sql = average_block("census.view.lookml", "  - dimension: ",
+                                 lambda block: "sql_case" in block)
+
+        start = time.time()
+        lookml.writelookupLookMLview(to_print, tables, "census_measures")
+        lookup_time = time.time() - start
+        lookup_size, lookup_lines = describe(
+            directory, ["census.view.lookml", "census_labels.view.lookml",
+                        "census_labels.joins.lookml"])
+        lookup_sql = average_block("census_labels.joins.lookml", "  - join: ")
+        csv_size = os.path.getsize("census_labels.csv")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+    print "  case: {:6.1f} MB, {:9,} lines of LookML, written in {:.2f}s, " \
+        "{:,} bytes of SQL per dimension".format(case_size / 1e6, case_lines,
+                                                 case_time, case_sql)
+    print "lookup: {:6.1f} MB, {:9,} lines of LookML, written in {:.2f}s, " \
+        "{:,} bytes of SQL per dimension (plus a {:.1f} MB label " \
+        "table)".format(lookup_size / 1e6, lookup_lines, lookup_time,
+                        lookup_sql, csv_size / 1e6)
+    print "The lookup layout is {:.0%} smaller".format(
+        1 - float(lookup_size) / case_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+
+# Times writing the three LookML views for a large merged codebook, comparing
+# the buffered writers with the line-at-a-time writers they replaced, and
+# writing the views one after another with writing them on separate threads.
+# Run from the root of the repository:
+#
+#   python benchmarks/bench_render.py -q 3000 -y 10
+
+import argparse
+import filecmp
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+import collections as coll
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from census_looker import lookml as lk  # noqa: E402
+from bench_lookml import merged_codebook  # noqa: E402
+
+
+parser = argparse.ArgumentParser(description='Benchmark LookML rendering')
+parser.add_argument('-q', '--questions', help='Questions in the first year',
+                    type=int, default=3000)
+parser.add_argument('-k', '--keys', help='Average value labels per question',
+                    type=int, default=40)
+parser.add_argument('-y', '--years', help='Number of yearly codebooks to '
+                    'merge', type=int, default=10)
+parser.add_argument('-g', '--growth', help='Questions added each year',
+                    type=int, default=50)
+parser.add_argument('-r', '--repeat', help='Best of this many runs',
+                    type=int, default=3)
+
+VIEWS = ("census.view.lookml", "census_filters.view.lookml",
+         "census_measures.view.lookml")
+
+
+def legacy_write(nested_cb, tables, weighted_measures):
+    # The three views as they were written before, a few bytes per call with
+    # the names and src_table checks worked out again for every value label
+    for dat, ques in nested_cb.iteritems():
+        lookml = open("census.view.lookml", "w")
+        lookml.write("- view: {}\n".format(dat))
+        lookml.write("  sql_table_name: [ENTER DATA FILE NAME HERE]\n\n\n")
+        lookml.write("  fields:\n")
+        for que, k in ques.iteritems():
+            if (k.codes and k.range is None):
+                lookml.write("  - dimension: {}\n".format(
+                    que.lower().replace('\u0007', '_')))
+                lookml.write("    label: \"{}\"\n".format(
+                    k.description.capitalize().rstrip()))
+                lookml.write("    view_label: Cohort {}\n".format(k.topic))
+                lookml.write("    type: string\n")
+                lookml.write("    sql_case:\n")
+                for key in k.value_labels():
+                    lookml.write("      {}: |\n".format(
+                        key.label.rstrip().replace(
+                            '#', '\\#').replace(':', '":"')))
+                    lookml.write("        ${{TABLE}}.{0} = {1}\n".format(
+                        que.lower().rstrip().split('\u0007')[0], key.code))
+                    if len(tables) > len(k.source):
+                        lookml.write("        AND ${TABLE}.src_table in ")
+                        lookml.write("({})\n".format(', '.join(
+                            "'" + item + "'" for item in k.source)))
+                lookml.write("\n\n")
+            elif (k.range is not None):
+                ends = k.range.split(':')
+                tiers = [int(math.ceil(float(ends[0]) +
+                                       x * float(ends[1]) / 4))
+                         for x in range(5)]
+                lookml.write("  - dimension: {}\n".format(
+                    que.lower().replace('\u0007', '_')))
+                if (k.description is not None):
+                    lookml.write("    label: \"{}\"\n".format(
+                        k.description.capitalize().rstrip()))
+                lookml.write("    view_label: Cohort {}\n".format(k.topic))
+                lookml.write("    type: tier\n")
+                lookml.write("    tiers: [{},{},{},{},{}]\n".format(*tiers))
+                lookml.write("    style: classic\n")
+                lookml.write("    sql: ${{TABLE}}.{}\n".format(que))
+                lookml.write("    sql: CASE WHEN "
+                             "${{TABLE}}.{} between {} AND {} "
+                             "THEN ${{TABLE}}.{} END".format(
+                                 que.lower(), ends[0], ends[1], que.lower()))
+                lookml.write("\n\n")
+        lookml.close()
+
+        lookml = open("census_filters.view.lookml", "w")
+        lookml.write("- view: {}_filters\n".format(dat))
+        lookml.write("  extends: {}\n".format(dat))
+        lookml.write("  fields:\n")
+        for ques_name, des in ques.iteritems():
+            lookml.write("  - filter: select_{}\n".format(
+                ques_name.lower().replace('\u0007', '_')))
+            lookml.write("    label: \"{}\"\n".format(
+                des.description.capitalize().rstrip()))
+            lookml.write("    view_label: Group {}\n".format(des.topic))
+            lookml.write("    suggest_dimension: {}\n".format(
+                ques_name.lower().replace('\u0007', '_')))
+            lookml.write("\n\n")
+        lookml.close()
+
+        lookml = open("census_measures.view.lookml", "w")
+        lookml.write("- view: {}_measures\n".format(dat))
+        lookml.write("  extends: {}_filters\n".format(dat))
+        lookml.write("  fields:\n")
+        for weighted_measure in weighted_measures:
+            suffix = ("_" + weighted_measure if len(weighted_measures) > 1
+                      else "")
+            lookml.write("  - measure: cohort_population{}\n".format(suffix))
+            lookml.write("    type: sum\n")
+            lookml.write("    view_label: Populations\n")
+            lookml.write("    value_format_name: decimal_0\n")
+            lookml.write("    sql: ${{TABLE}}.{}".format(weighted_measure))
+            lookml.write("\n\n")
+            lookml.write("  - measure: group_population{}\n".format(suffix))
+            lookml.write("    type: sum\n")
+            lookml.write("    view_label: Populations\n")
+            lookml.write("    value_format_name: decimal_0\n")
+            lookml.write("    sql: |\n")
+            lookml.write("      CASE WHEN\n")
+            i = 0
+            for ques_name, des in ques.iteritems():
+                if (des.codes or des.range is not None):
+                    lookml.write(
+                        """      {} {{% condition select_{} %}}
+                        ${{{}}} {{%endcondition%}} \n""".format(
+                            "AND" if i > 0 else "", ques_name.lower().replace(
+                                '\u0007', '_'), ques_name.lower().replace(
+                                '\u0007', '_')))
+                    i += 1
+            lookml.write("      THEN {}\n".format(weighted_measure))
+            lookml.write("      ELSE 0\n")
+            lookml.write("      END\n")
+            lookml.write("\n\n")
+        lookml.close()
+
+
+def write_serial(nested_cb, tables, weighted_measures):
+    fragments = lk.lookml_fragments(nested_cb, tables)
+    lk.writebaseLookMLview(nested_cb, tables, fragments)
+    lk.writefilteredview(nested_cb, tables, fragments)
+    lk.writemeasures(nested_cb, tables, weighted_measures, fragments)
+
+
+def write_threaded(nested_cb, tables, weighted_measures):
+    fragments = lk.lookml_fragments(nested_cb, tables)
+    pool = ThreadPool(3)
+    pool.map(lk.write_lookml, [
+        (lk.writebaseLookMLview, (nested_cb, tables, fragments)),
+        (lk.writefilteredview, (nested_cb, tables, fragments)),
+        (lk.writemeasures, (nested_cb, tables, weighted_measures,
+                                fragments))])
+    pool.close()
+    pool.join()
+
+
+def time_writer(writer, directory, nested_cb, tables, weighted_measures,
+                repeat):
+    os.mkdir(directory)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            writer(nested_cb, tables, weighted_measures)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        os.chdir(cwd)
+    return best
+
+
+def main():
+    args = parser.parse_args()
+    tables, merged = merged_codebook(args.questions, args.keys, args.years,
+                                     args.growth)
+    nested_cb = coll.OrderedDict([("census", merged)])
+    weighted_measures = ["PWSSWGT", "PWCMPWGT"]
+    print "{:,} questions merged from {} codebooks".format(len(merged),
+                                                           args.years)
+
+    root = tempfile.mkdtemp()
+    try:
+        results = []
+        for name, writer in (("line at a time", legacy_write),
+                             ("buffered", write_serial),
+                             ("buffered, threaded", write_threaded)):
+            directory = os.path.join(root, writer.__name__)
+            results.append((name, directory, time_writer(
+                writer, directory, nested_cb, tables, weighted_measures,
+                args.repeat)))
+
+        size = sum(os.path.getsize(os.path.join(results[0][1], view))
+                   for view in VIEWS)
+        print "{:.1f} MB of LookML".format(size / 1e6)
+        for name, directory, elapsed in results:
+            # Every writer has to produce exactly the same views
+            same = all(filecmp.cmp(os.path.join(results[0][1], view),
+                                   os.path.join(directory, view),
+                                   shallow=False) for view in VIEWS)
+            print "{:>20}: {:6.3f}s  {:5.1f}x{}".format(
+                name, elapsed, results[0][2] / elapsed,
+                "" if same else "  OUTPUT DIFFERS")
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+#!/usr/bin/python
+
+# Benchmarks every stage of both scripts on synthetic DataFerrett downloads:
+# a codebook and a datafile for each yearly source, at whatever width,
+# height and number of value labels you ask for. Each stage runs in its own
+# process so its peak memory can be measured, and the results are written to
+# a JSON file. If there's a baseline from an earlier run with the same
+# settings, each stage is compared against it and regressions are reported.
+# Run from the root of the repository:
+#
+#   python benchmarks/bench_suite.py --save-baseline
+#   (make changes)
+#   python benchmarks/bench_suite.py
+
+import argparse
+import collections as coll
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from census_looker import codebook as cp  # noqa: E402
+from census_looker import lookml  # noqa: E402
+from census_looker import schema as sg  # noqa: E402
+from bench_codebook import synthetic_codebook, quiet  # noqa: E402
+
+
+parser = argparse.ArgumentParser(description='Benchmark both scripts on '
+                                 'synthetic DataFerrett downloads')
+parser.add_argument('-w', '--width', help='Questions (and so datafile '
+                    'columns) in the first year', type=int, default=500)
+parser.add_argument('-r', '--rows', help='Rows in each datafile', type=int,
+                    default=20000)
+parser.add_argument('-k', '--keys', help='Average value labels per question',
+                    type=int, default=40)
+parser.add_argument('-y', '--years', help='Number of yearly sources',
+                    type=int, default=5)
+parser.add_argument('-g', '--growth', help='Questions added each year',
+                    type=int, default=20)
+parser.add_argument('-n', '--repeat', help='Best of this many runs of each '
+                    'stage', type=int, default=3)
+parser.add_argument('-o', '--output', help='File to write the results to',
+                    default=os.path.join(os.path.dirname(__file__),
+                                         'results.json'))
+parser.add_argument('-b', '--baseline', help='Results to compare against',
+                    default=os.path.join(os.path.dirname(__file__),
+                                         'baseline.json'))
+parser.add_argument('--save-baseline', help='Store this run as the baseline '
+                    'instead of comparing against it', action='store_true')
+parser.add_argument('--tolerance', help='How much slower or bigger a stage '
+                    'can get before it counts as a regression', type=float,
+                    default=0.2)
+
+WEIGHTS = ["PWSSWGT"]
+
+
+def synthetic_datafile(path, ques, rows, seed=0):
+    # A datafile to match a parsed codebook: a column per question holding
+    # its codes, or numbers in its range with the odd sentinel, and a
+    # weight. A thousand distinct rows are repeated to the height asked
+    # for, which keeps generating large files quick.
+    rng = random.Random(seed)
+    columns = []
+    for que, k in ques.iteritems():
+        if k.range is not None:
+            low, high = [int(float(end)) for end in k.range.split(':')]
+            columns.append(range(low, high + 1) + ["-1"])
+        else:
+            columns.append(k.codes)
+    distinct = []
+    for r in range(min(rows, 1000)):
+        row = [str(rng.choice(values)) for values in columns]
+        row.append("{:.4f}".format(rng.uniform(500, 5000)))
+        distinct.append(",".join(row) + "\n")
+    with open(path, "w") as f:
+        f.write(",".join(ques.keys() + WEIGHTS) + "\n")
+        for r in range(rows):
+            f.write(distinct[r % len(distinct)])
+
+
+def generate(directory, args):
+    # Writes a codebook and a datafile for each year, returning their paths
+    # and table names
+    sources = []
+    for year in range(args.years):
+        table = "cps_{}".format(year)
+        codebook = os.path.join(directory, table + ".txt")
+        with open(codebook, "w") as f:
+            f.write(synthetic_codebook(args.width + year * args.growth,
+                                       args.keys, "CPS//Synthetic"))
+        datafile = os.path.join(directory, table + ".csv")
+        quiet(True)
+        try:
+            ques = cp.parse_file((codebook, table))[table]
+        finally:
+            quiet(False)
+        synthetic_datafile(datafile, ques, args.rows, seed=year)
+        sources.append((codebook, datafile, table))
+    return sources
+
+
+def parse_all(sources):
+    return [cp.parse_file((codebook, table))[table]
+            for codebook, datafile, table in sources]
+
+
+def merge_all(sources):
+    merged = coll.OrderedDict()
+    for ques, (codebook, datafile, table) in zip(parse_all(sources),
+                                                 sources):
+        merged = cp.dict_merge(ques, table, merged)
+    return coll.OrderedDict([("census", merged)])
+
+
+def output_size(names):
+    return sum(os.path.getsize(name) for name in names)
+
+
+# Stages this much slower than the baseline or less are within the noise of
+# the timer, however big the ratio
+NOISE_SECONDS = 0.01
+
+
+# Each stage takes the sources and a working directory, does any setup that
+# isn't being measured, and returns a function to time. That function hands
+# back how much work it did, in the stage's unit, and the bytes it wrote.
+
+def stage_get_types(sources, directory):
+    # get_types only reads a sample of rows from the top of each file, so
+    # its throughput is in rows sampled rather than the size of the file
+    def run():
+        for codebook, datafile, table in sources:
+            sg.get_types(datafile)
+        return len(sources) * sg.SAMPLE_ROWS, 0
+    return "rows", run
+
+
+def stage_stream_types(sources, directory):
+    def run():
+        sg.stream_types([datafile for c, datafile, t in sources], 1, map)
+        return output_size(datafile for c, datafile, t in sources) / 1e6, 0
+    return "MB", run
+
+
+def stage_parseCodebook(sources, directory):
+    def run():
+        parse_all(sources)
+        return output_size(codebook for codebook, d, t in sources) / 1e6, 0
+    return "MB", run
+
+
+def stage_dict_merge(sources, directory):
+    parsed = parse_all(sources)
+
+    def run():
+        merged = coll.OrderedDict()
+        for ques, (codebook, datafile, table) in zip(parsed, sources):
+            merged = cp.dict_merge(ques, table, merged)
+        return sum(len(ques) for ques in parsed), 0
+    return "questions", run
+
+
+def writer_stage(write, names):
+    def stage(sources, directory):
+        nested_cb = merge_all(sources)
+        tables = [table for codebook, datafile, table in sources]
+        fragments = lookml.lookml_fragments(nested_cb, tables)
+
+        def run():
+            write(nested_cb, tables, fragments)
+            size = output_size(names)
+            return size / 1e6, size
+        return "MB", run
+    return stage
+
+
+STAGES = coll.OrderedDict([
+    ("get_types", stage_get_types),
+    ("stream_types", stage_stream_types),
+    ("parseCodebook", stage_parseCodebook),
+    ("dict_merge", stage_dict_merge),
+    ("writebaseLookMLview", writer_stage(
+        lambda nested_cb, tables, fragments: lookml.writebaseLookMLview(
+            nested_cb, tables, fragments),
+        ["census.view.lookml"])),
+    ("writelookupLookMLview", writer_stage(
+        lambda nested_cb, tables, fragments: lookml.writelookupLookMLview(
+            nested_cb, tables, "census_measures", fragments),
+        ["census.view.lookml", "census_labels.csv",
+         "census_labels.view.lookml", "census_labels.joins.lookml"])),
+    ("writefilteredview", writer_stage(
+        lambda nested_cb, tables, fragments: lookml.writefilteredview(
+            nested_cb, tables, fragments),
+        ["census_filters.view.lookml"])),
+    ("writemeasures", writer_stage(
+        lambda nested_cb, tables, fragments: lookml.writemeasures(
+            nested_cb, tables, WEIGHTS, fragments),
+        ["census_measures.view.lookml"])),
+])
+
+
+def run_stage(queue, name, sources, directory):
+    # Runs in a child process, so ru_maxrss is the peak of this stage alone
+    # (along with the inputs it needs) rather than of the whole suite
+    quiet(True)
+    try:
+        os.chdir(directory)
+        unit, run = STAGES[name](sources, directory)
+        start = time.time()
+        work, written = run()
+        elapsed = time.time() - start
+    finally:
+        quiet(False)
+    queue.put(coll.OrderedDict([
+        ("seconds", elapsed),
+        ("throughput", work / elapsed),
+        ("unit", "{}/s".format(unit)),
+        ("peak_rss_mb", resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024.0),
+        ("output_bytes", written)]))
+
+
+def measure(name, sources, directory, repeat):
+    # The fastest of several runs, and the most memory any of them used
+    best = None
+    for _ in range(repeat):
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(target=run_stage, args=(
+            queue, name, sources, directory))
+        child.start()
+        result = queue.get()
+        child.join()
+        if best is None or result["seconds"] < best["seconds"]:
+            result["peak_rss_mb"] = max(result["peak_rss_mb"],
+                                        best["peak_rss_mb"] if best else 0)
+            best = result
+        else:
+            best["peak_rss_mb"] = max(best["peak_rss_mb"],
+                                      result["peak_rss_mb"])
+    return best
+
+
+def compare(results, baseline, tolerance):
+    # Prints each stage against the baseline and returns the names of the
+    # stages that got slower or bigger by more than the tolerance
+    regressions = []
+    print "\n{:>22} {:>10} {:>10} {:>10}".format(
+        "", "time", "peak RSS", "output")
+    for name, result in results["stages"].iteritems():
+        before = baseline["stages"].get(name)
+        if before is None:
+            print "{:>22} (not in the baseline)".format(name)
+            continue
+        ratios = [float(result[key]) / before[key] if before[key] else 1.0
+                  for key in ("seconds", "peak_rss_mb", "output_bytes")]
+        regressed = any(ratio > 1 + tolerance for ratio in ratios)
+        if (ratios[0] > 1 + tolerance and
+                result["seconds"] - before["seconds"] < NOISE_SECONDS and
+                not any(ratio > 1 + tolerance for ratio in ratios[1:])):
+            regressed = False
+        if regressed:
+            regressions.append(name)
+        print "{:>22} {:>9.2f}x {:>9.2f}x {:>9.2f}x{}".format(
+            name, *(ratios + ["  REGRESSION" if regressed else ""]))
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+    config = coll.OrderedDict(
+        (key, getattr(args, key))
+        for key in ("width", "rows", "keys", "years", "growth"))
+    results = coll.OrderedDict([
+        ("config", config),
+        ("python", platform.python_version()),
+        ("platform", platform.platform()),
+        ("stages", coll.OrderedDict())])
+
+    directory = tempfile.mkdtemp()
+    try:
+        print "Generating {years} years of {width}+ questions and {rows:,} " \
+            "rows".format(**config)
+        sources = generate(directory, args)
+        for name in STAGES:
+            result = measure(name, sources, directory, args.repeat)
+            results["stages"][name] = result
+            print "{:>22}: {:7.3f}s {:>12,.1f} {:<12} {:7.1f} MB peak " \
+                "RSS".format(name, result["seconds"], result["throughput"],
+                             result["unit"], result["peak_rss_mb"])
+    finally:
+        shutil.rmtree(directory)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print "Results written to {}".format(args.output)
+
+    if args.save_baseline:
+        shutil.copy(args.output, args.baseline)
+        print "Saved as the baseline in {}".format(args.baseline)
+        return
+    if not os.path.exists(args.baseline):
+        print "No baseline to compare against; save one with --save-baseline"
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["config"] != config:
+        print "The baseline was run with different settings ({}), so it " \
+            "can't be compared".format(json.dumps(baseline["config"]))
+        return
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print "Regressed: {}".format(", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
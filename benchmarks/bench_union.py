@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+# Compares building the union query the way schema_generator used to (a set
+# of the fields rebuilt for every field checked) with the indexed builder,
+# on synthetic schemas as wide as the ACS extracts, where each year adds
+# and drops a few columns. Run from the root of the repository:
+#
+#   python benchmarks/bench_union.py -w 2500 -y 10
+
+import argparse
+import collections as coll
+import os
+import random
+import sys
+import time
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from census_looker import schema as sg  # noqa: E402
+
+
+parser = argparse.ArgumentParser(description='Benchmark building the union '
+                                 'query')
+parser.add_argument('-w', '--width', help='Columns in each datafile',
+                    type=int, default=2500)
+parser.add_argument('-y', '--years', help='Number of datafiles', type=int,
+                    default=10)
+parser.add_argument('-c', '--churn', help='Columns replaced each year',
+                    type=int, default=50)
+
+
+def synthetic_schemas(width, years, churn, seed=0):
+    rng = random.Random(seed)
+    columns = ["COL{}".format(c) for c in range(width)]
+    schemas, added = [], width
+    for year in range(years):
+        schemas.append(coll.OrderedDict(
+            (column, rng.choice(sg.TYPE_ORDER)) for column in columns))
+        for _ in range(churn):
+            columns[rng.randrange(width)] = "COL{}".format(added)
+            added += 1
+    return schemas
+
+
+def legacy_union(schemas, tables):
+    master_field_list = []
+    for schema in schemas:
+        for field in schema:
+            if field not in set(master_field_list):
+                master_field_list.append(field)
+    subselect_list = []
+    for schema, table in zip(schemas, tables):
+        field_list = []
+        for field in master_field_list:
+            if field in set(schema):
+                field_list.append(field)
+            else:
+                field_list.append("NULL AS {} ".format(field))
+        subselect = "(SELECT " + ", ".join(field_list)
+        subselect += ", " + "'" + table + "'" + " as src_table"
+        subselect += " FROM " + table + ")"
+        subselect_list.append(subselect)
+    return "SELECT * FROM " + ", \n".join(subselect_list)
+
+
+def indexed_union(schemas, tables):
+    output = StringIO()
+    sg.write_union(output, sg.master_fields(schemas), schemas, tables)
+    return output.getvalue()
+
+
+def main():
+    args = parser.parse_args()
+    schemas = synthetic_schemas(args.width, args.years, args.churn)
+    tables = ["acs_{}".format(year) for year in range(args.years)]
+    print "{} datafiles of {} columns, {} in all".format(
+        args.years, args.width, len(sg.master_fields(schemas)))
+
+    results = {}
+    for name, build in (("legacy", legacy_union),
+                        ("indexed", indexed_union)):
+        start = time.time()
+        results[name] = build(schemas, tables), time.time() - start
+        print "{:>8}: {:.3f}s".format(name, results[name][1])
+
+    if results["legacy"][0] != results["indexed"][0]:
+        print "WARNING: the union queries differ"
+    print "Speedup: {:.1f}x".format(results["legacy"][1] /
+                                    results["indexed"][1])
+
+
+if __name__ == '__main__':
+    main()
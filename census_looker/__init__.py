@@ -0,0 +1,16 @@
+# Turns DataFerrett downloads into BigQuery tables and LookML. The scripts in
+# the root of the repository are thin command line wrappers around this
+# package, which can also be imported into a long-running process: nothing
+# happens at import time, and the functions below take everything they need
+# as arguments.
+
+import logging
+
+from census_looker.codebook import (CodebookCache, Question, key_chooser,
+                                    merge, parse_codebook)
+from census_looker.lookml import ViewManifest, quantile_tiers, render_views
+from census_looker.schema import SchemaCache, infer_schema
+
+# Progress is reported through logging, which stays quiet unless the
+# application using the package configures it
+logging.getLogger(__name__).addHandler(logging.NullHandler())
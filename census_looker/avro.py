@@ -0,0 +1,172 @@
+# Writing typed, unioned rows to an Avro container file that BigQuery can
+# load directly.
+
+import csv
+import json
+import logging
+import os
+import re
+import struct
+import time
+import zlib
+
+from census_looker import metrics
+from census_looker.schema import iter_lines, open_datafile
+
+
+log = logging.getLogger(__name__)
+
+
+# Avro longs (like BigQuery INTEGERs) are signed 64-bit
+LONG_MIN, LONG_MAX = -1 << 63, (1 << 63) - 1
+
+
+def avro_long(n):
+    # Avro writes integers as zig-zag encoded variable-length quantities.
+    # Anything wider than 64 bits would come out as a different number.
+    if not LONG_MIN <= n <= LONG_MAX:
+        raise ValueError("{} is too large for a 64-bit integer".format(n))
+    n = (n << 1) ^ (n >> 63)
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return str(out)
+
+
+def avro_string(value):
+    return avro_long(len(value)) + value
+
+
+# Every column is nullable, so each value is preceded by its branch of the
+# ["null", type] union: 0 for a null and 1 for a value
+AVRO_NULL = avro_long(0)
+AVRO_VALUE = avro_long(1)
+
+
+def encode_integer(value):
+    try:
+        n = int(value)
+    except ValueError:
+        # Values such as 1.0 were classified as integers too
+        n = int(float(value))
+    return AVRO_VALUE + avro_long(n)
+
+
+def encode_float(value):
+    return AVRO_VALUE + struct.pack("<d", float(value))
+
+
+def encode_string(value):
+    return AVRO_VALUE + avro_string(value)
+
+
+AVRO_TYPES = {"INTEGER": ("long", encode_integer),
+              "FLOAT": ("double", encode_float),
+              "STRING": ("string", encode_string)}
+
+
+class AvroWriter(object):
+    # Writes rows to a deflate-compressed Avro container file, which BigQuery
+    # can load directly. Rows are buffered and written out a block at a time,
+    # so memory use is bounded by the block size rather than the file size.
+
+    def __init__(self, path, fields, block_size=10000):
+        self.fields = fields
+        self.block_size = block_size
+        self.encoders = [AVRO_TYPES[t][1] for _, t in fields]
+        self.sync = os.urandom(16)
+        self.block, self.rows = [], 0
+        schema = {"type": "record", "name": "census",
+                  "fields": [{"name": re.sub(r'\W', '_', name),
+                              "type": ["null", AVRO_TYPES[t][0]],
+                              "default": None} for name, t in fields]}
+        self.f = open(path, "wb")
+        self.f.write("Obj\x01")
+        metadata = (("avro.schema", json.dumps(schema)),
+                    ("avro.codec", "deflate"))
+        self.f.write(avro_long(len(metadata)))
+        for key, value in metadata:
+            self.f.write(avro_string(key) + avro_string(value))
+        self.f.write(avro_long(0) + self.sync)
+
+    def write(self, row):
+        # Empty cells load as NULLs, except in string columns where an empty
+        # string is a value in its own right
+        try:
+            self.block.append("".join(
+                self.encode(value, encode, t)
+                for value, encode, (_, t) in zip(row, self.encoders,
+                                                 self.fields)))
+        except ValueError:
+            # Only now do we go back and find the column that failed, so the
+            # error can say which one it was
+            for value, encode, (name, t) in zip(row, self.encoders,
+                                                self.fields):
+                try:
+                    self.encode(value, encode, t)
+                except ValueError as e:
+                    raise ValueError(
+                        "Can't write {!r} to {} column {} in Avro ({}); the "
+                        "column needs a wider type".format(value, t, name, e))
+            raise
+        if len(self.block) >= self.block_size:
+            self.flush()
+
+    @staticmethod
+    def encode(value, encode, t):
+        if value is None or (value == "" and t != "STRING"):
+            return AVRO_NULL
+        return encode(value)
+
+    def flush(self):
+        if not self.block:
+            return
+        # Avro's deflate codec is raw deflate, without the zlib header
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        data = compressor.compress("".join(self.block)) + compressor.flush()
+        self.f.write(avro_long(len(self.block)) + avro_long(len(data)))
+        self.f.write(data + self.sync)
+        self.rows += len(self.block)
+        self.block = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+@metrics.timed("write_avro")
+def write_avro(path, datafiles, table_names, master_field_list, field_types,
+               block_size=10000):
+    # Stream every datafile through the unioned schema into one Avro file.
+    # Columns a file doesn't have are NULL, and each row carries the
+    # src_table column the union query would otherwise add.
+    start = time.time()
+    fields = [(field, field_types[field]) for field in master_field_list]
+    writer = AvroWriter(path, fields + [("src_table", "STRING")], block_size)
+    for df, table in zip(datafiles, table_names):
+        with open_datafile(df) as csvfile:
+            reader = csv.reader(iter_lines(csvfile), delimiter=',')
+            header_row = next(reader)
+            positions = dict((field, c) for c, field in enumerate(header_row))
+            columns = [positions.get(field) for field in master_field_list]
+            width = len(header_row)
+            # Blank lines are skipped, as they are when inferring types, and
+            # rows are numbered the same way, counting from the first after
+            # the header
+            for r, row in enumerate(reader, 1):
+                if len(row) != width:
+                    if not row:
+                        continue
+                    raise ValueError("{}: Row {} has {} fields, but the "
+                                     "header has {}".format(df, r, len(row),
+                                                            width))
+                writer.write([None if c is None else row[c]
+                              for c in columns] + [table])
+    writer.close()
+    metrics.count("avro rows", writer.rows)
+    metrics.count("avro bytes", os.path.getsize(path))
+    log.info("Wrote {} rows to {} in {:.1f}s".format(writer.rows, path,
+                                                     time.time() - start))
+
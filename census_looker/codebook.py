@@ -0,0 +1,340 @@
+# Parsing DataFerrett codebooks into Questions and merging the codebooks of
+# several datasets (or years of one) into a single set of questions.
+
+import collections as coll
+import logging
+import os
+import re
+
+from census_looker import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+# The codebook is composed of definitions for all downloaded variables.
+# Each line can be parsed independently to figure out what part of a definition
+# it makes up.
+
+
+# Below, we define the regular expressions needed to identify the different
+# definition parts. Each one names its capture so that they can all be
+# combined into a single regex (see codebook_line_re).
+
+# The dataset name is prefaced by Dataset:
+dataset_pat = r'(?P<dataset>Dataset: .*)'
+# The topic name is prefaced by Topic:
+topic_cap_pat = r'Topic: (?P<topic>[A-z ]*)'
+# Question names are composed of up to 8 capital letters and/or digits
+q_name_cap_pat = r'(?P<q_name>[A-Z\d]{1,8})$'
+# Question descriptions have the topic name, then a dash, and the q description
+q_description_cap_pat = r'-(?!\s)(?P<description>[\w\d\W\s]*$)'
+# Newer questions don't necessarily have this format
+new_q_description_cap_re = re.compile(
+    r'(?:\s-\s)?([\w\d\W\s]*$)')
+
+# Some questions' valid values are defined as a set of key/value pairs while
+# others are composed of ranges of valid values
+
+# For key/value pairs, format is a number, then two spaces and then the name
+key_val_cap_pat = r'(?P<key>-?[0-9]*) {2}(?P<value>[A-z 0-9\W]*)$'
+# For value ranges, the range is shown as min:max, then the name of the range
+val_range_cap_pat = (r'(?P<range>-?[0-9.]+:-?[0-9.]+)  '
+                     '(?:Hours|Range|Year|# of own children under 18'
+                     ' years of age|Specific City Code|Line number|'
+                     'persons)$')
+
+# Running each pattern in turn would cost up to ten regex matches per line,
+# plus a second pass to pull out the captured text. Instead we combine them
+# into one alternation, in order of precedence, so each line is classified
+# and captured in a single match. Since Q description requires relatively
+# permissive regex, it comes after the more restrictive fields.
+codebook_line_re = re.compile("|".join((
+    dataset_pat, topic_cap_pat, q_name_cap_pat, key_val_cap_pat,
+    val_range_cap_pat, q_description_cap_pat)))
+
+weird_lines = frozenset((
+    """Demographics - age topcoded at 85, 90 or 80
+                (see full description)""",
+    "Educational Attainment (recode - 4 categories)",
+    "Educational Attainment (recode - 5 categories)"))
+
+ignorable = frozenset(("DataFerrett Codebook - Created",
+                       "With the following Ranges:",
+                       "Is a recode of the variable(s) PEMLR",
+                       "Is a recode of the variable(s) PEEDUCA"))
+
+
+class ValueLabel(object):
+    # One coded value of a question and the label DataFerrett gives it
+    __slots__ = ("code", "label")
+
+    def __init__(self, code, label):
+        self.code = code
+        self.label = label
+
+
+class Question(object):
+    # One variable from a codebook. A merged codebook holds thousands of
+    # these, so rather than a dict per question (and another per set of
+    # value labels) the fields live in slots and the value labels in two
+    # parallel lists. Topics, codes and labels repeat endlessly across
+    # questions and codebooks, so they're interned and stored only once.
+    __slots__ = ("topic", "source", "codes", "labels", "range",
+                 "description", "_digest", "_positions")
+
+    def __init__(self, topic, source):
+        self.topic = intern(topic)
+        self.source = [source]
+        self.codes = []
+        self.labels = []
+        self.range = None
+        self.description = None
+        self._digest = None
+        self._positions = None
+
+    def add_value_label(self, code, label):
+        code, label = intern(code), intern(label)
+        # A code that's listed twice keeps its first position but takes the
+        # later label. Where each code sits is kept in a dict while the
+        # question is parsed, since industry and occupation questions have
+        # thousands of codes to check against.
+        if self._positions is None:
+            self._positions = dict((c, i) for i, c in enumerate(self.codes))
+        position = self._positions.get(code)
+        if position is None:
+            self._positions[code] = len(self.codes)
+            self.codes.append(code)
+            self.labels.append(label)
+        else:
+            self.labels[position] = label
+
+    def done_parsing(self):
+        # The positions are only needed to add labels, so they aren't kept
+        # for the thousands of questions in a merged codebook
+        self._positions = None
+
+    def __getstate__(self):
+        # Questions are pickled to send them back from parsing workers, so we
+        # keep the pickle to a bare tuple of values
+        return (self.topic, self.source, self.codes, self.labels, self.range,
+                self.description)
+
+    def __setstate__(self, state):
+        (self.topic, self.source, self.codes, self.labels, self.range,
+         self.description) = state
+        # Strings lose their interning on the way through a pickle
+        self.topic = intern(self.topic)
+        self.codes = map(intern, self.codes)
+        self.labels = map(intern, self.labels)
+        self._digest = None
+        self._positions = None
+
+    def value_labels(self):
+        for code, label in zip(self.codes, self.labels):
+            yield ValueLabel(code, label)
+
+    def content(self):
+        # Everything that defines the question except where it came from,
+        # which is what two codebooks have to agree on to share a question
+        return (self.topic, self.description, tuple(self.codes),
+                tuple(self.labels), self.range)
+
+    def digest(self):
+        # A hash of the content, so that a question already in a merged
+        # codebook can be matched against a new one without walking their
+        # value labels again. Questions don't change once their codebook is
+        # parsed, so it's only worked out the first time it's needed.
+        if self._digest is None:
+            self._digest = hash(self.content())
+        return self._digest
+
+    def copy(self):
+        # Merging adds to a question's sources, so a parsed codebook that's
+        # kept around to be merged again gets copies of its questions. Only
+        # the sources list is new; the value labels are never changed.
+        question = Question.__new__(Question)
+        question.__setstate__(self.__getstate__())
+        question.source = list(self.source)
+        question._digest = self._digest
+        return question
+
+
+@metrics.timed("parseCodebook")
+def parseCodebook(cb, tb):
+    log.info("Parsing " + tb)
+
+    # The order of the questions in the codebook isn't strictly necessary, but
+    # preserving the order lets value sorting work and makes it easier to
+    # compare input to output, so we'll use OrderedDict to preserve order
+
+    parsed_cb = coll.OrderedDict()
+
+    # For each line, we'll work our way down the hierarchy (dataset -> topic ->
+    # question -> values) looking for regex matches and filling out the nested
+    # dictionary as we go. Lines are read one at a time rather than loading
+    # the whole codebook into memory.
+    q_id_line = 0
+    i = 0
+    for i, line in enumerate(cb, 1):
+        match = codebook_line_re.match(line)
+        # lastgroup names the alternative that matched (for key/value pairs,
+        # the value group, since it's the last of the two)
+        kind = match.lastgroup if match else None
+        if kind == "dataset":
+            parsed_cb[tb] = coll.OrderedDict()
+            q_id_line = 0
+        elif kind == "topic":
+            topic = match.group("topic")
+            q_id_line = 0
+        elif kind == "q_name":
+            q_name = match.group("q_name")
+            if q_name not in parsed_cb[tb]:
+                parsed_cb[tb][q_name] = Question(topic, tb)
+                q_id_line = 1
+        elif kind == "value":
+            parsed_cb[tb][q_name].add_value_label(match.group("key"),
+                                                  match.group("value"))
+            q_id_line = 0
+        elif kind == "range":
+            parsed_cb[tb][q_name].range = match.group("range")
+            q_id_line = 0
+        elif kind == "description":
+            parsed_cb[tb][q_name].description = match.group("description")
+            q_id_line = 0
+        # Since Q description formatting has become more unpredictable lately
+        # we also track whether the previous line was a Q name and use that
+        # as a backup identifier of a Q description
+        elif q_id_line:
+            q_description = new_q_description_cap_re.match(line).group(1)
+            parsed_cb[tb][q_name].description = q_description
+            q_id_line = 0
+        # If a line is empty or has a section title, we ignore it.
+        elif not line.strip() or line.rstrip() in ignorable:
+            q_id_line = 0
+        # Finally, check the line against our list of non-conforming lines
+        elif line.rstrip() in weird_lines:
+            q_description = line
+            parsed_cb[tb][q_name].description = q_description
+            q_id_line = 0
+        # If we don't recognize a line, we print it for examination
+        else:
+            log.warning("Unable to parse line " + str(i) + " - " + line)
+            metrics.count("unparsed codebook lines")
+            q_id_line = 0
+    for question in parsed_cb.get(tb, {}).itervalues():
+        question.done_parsing()
+    metrics.count("codebook lines", i)
+    metrics.count("questions parsed", len(parsed_cb.get(tb, ())))
+    return parsed_cb
+
+
+def parse_file(job):
+    # Parse one codebook file. This lives at the module level so that worker
+    # processes can unpickle it.
+    codebook, table = job
+    with open(codebook) as cb:
+        return parseCodebook(cb, table)
+
+
+@metrics.timed("dict_merge")
+def dict_merge(to_merge, table_to_merge, final_dict, chooser=None):
+    # Each question only needs a dict lookup and a comparison against the
+    # one question of the same name, so merging a codebook costs the size
+    # of that codebook, however many have been merged before it. When two
+    # versions of a question differ, the chooser picks one (0 or 1) or
+    # "split"s them; by default we ask.
+    chooser = chooser or key_chooser
+    metrics.count("questions merged", len(to_merge))
+    for k, v in to_merge.iteritems():
+        if k in final_dict:
+            # Digests tell most differing questions apart cheaply, but two
+            # can collide, so matching ones are compared in full
+            if (v.digest() == final_dict[k].digest() and
+                    v.content() == final_dict[k].content()):
+                final_dict[k].source.append(table_to_merge)
+            else:
+                choice = chooser([v, final_dict[k]])
+                metrics.count("merge conflicts")
+                if choice == 0:
+                    final_dict[k].source.append(table_to_merge)
+                elif choice == 1:
+                    v.source += final_dict[k].source
+                    final_dict[k] = v
+                elif choice == 'split':
+                    final_dict[k + "\u0007" + table_to_merge] = v
+        else:
+            final_dict[k] = v
+    return final_dict
+
+
+def key_chooser(choices):
+    print "\n Questions differ. Choose the version to keep,",
+    print 'or split them into separate questions:'
+    first, second = choices
+    for field in ("topic", "description", "codes", "range"):
+        if field == "codes":
+            # For value labels, we show the codes whose labels differ
+            second_labels = dict(zip(second.codes, second.labels))
+            for code, label in zip(first.codes, first.labels):
+                if code in second_labels and second_labels[code] != label:
+                    print code + ": [1] " + label.rstrip(),
+                    print "vs. [2] " + second_labels[code].rstrip()
+        elif (isinstance(getattr(first, field), str) and
+                getattr(first, field) != getattr(second, field)):
+            print "[1] " + getattr(first, field).rstrip() + ' vs.',
+            print "[2] " + (getattr(second, field) or "").rstrip()
+    print "Version [1], Version [2], Or Type [3] to Split: \n>>"
+    # Prompt for input and validate the input
+    while True:
+        action = raw_input()
+        if action in ('1', '2'):
+            return int(action) - 1
+        elif action == '3':
+            return "split"
+        print "Invalid Input"
+
+
+def parse_codebook(codebook, table):
+    # The questions of one codebook, given its path or an open file
+    if isinstance(codebook, basestring):
+        return parse_file((codebook, table))[table]
+    return parseCodebook(codebook, table)[table]
+
+
+def merge(codebooks, tables, chooser=None):
+    # Merge parsed codebooks, in order, into one OrderedDict of questions,
+    # each knowing which of the tables it came from. The codebooks passed in
+    # are left as they were, so they can be merged again.
+    merged = coll.OrderedDict()
+    for questions, table in zip(codebooks, tables):
+        merged = dict_merge(
+            coll.OrderedDict((name, question.copy())
+                             for name, question in questions.iteritems()),
+            table, merged, chooser)
+    return merged
+
+
+class CodebookCache(object):
+    # Keeps parsed codebooks in memory, so a long-running process that sees
+    # the same codebook again only parses it once. Codebooks are keyed by
+    # path and table and checked against their size and modification time.
+
+    def __init__(self, max_entries=100):
+        self.max_entries = max_entries
+        self.entries = coll.OrderedDict()
+
+    def parse(self, path, table):
+        key = (os.path.abspath(path), table)
+        fingerprint = (os.path.getsize(path), os.path.getmtime(path))
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[0] != fingerprint:
+            metrics.count("codebook cache misses")
+            entry = (fingerprint, parse_codebook(path, table))
+        else:
+            metrics.count("codebook cache hits")
+        # The most recently used codebooks are kept at the end
+        self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry[1]
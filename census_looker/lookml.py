@@ -0,0 +1,707 @@
+# Rendering merged codebooks as LookML views: dimensions, filters, measures,
+# label lookup tables and rollups.
+
+import collections as coll
+import csv
+import functools
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import threading
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+from census_looker import metrics
+from census_looker.schema import (QuantileSketch, SENTINELS, iter_lines,
+                                  open_datafile)
+
+
+log = logging.getLogger(__name__)
+
+
+@metrics.timed("sketch_datafile")
+def sketch_datafile(job):
+    # Stream the Range columns of one datafile through quantile sketches,
+    # leaving out the values the codebook labels (and DataFerrett's other
+    # sentinel codes) since they aren't part of the range. This lives at
+    # the module level so that worker processes can unpickle it.
+    datafile, columns = job
+    with open_datafile(datafile) as f:
+        reader = csv.reader(iter_lines(f))
+        header = [name.strip().lower() for name in next(reader)]
+        indexes = [(header.index(column), column, excluded)
+                   for column, excluded in columns.iteritems()
+                   if column in header]
+        sketches = dict((column, QuantileSketch()) for i, column, excluded
+                        in indexes)
+        rows = 0
+        for rows, row in enumerate(reader, 1):
+            for i, column, excluded in indexes:
+                try:
+                    value = float(row[i])
+                except (IndexError, ValueError):
+                    continue
+                if value not in excluded:
+                    sketches[column].update(value)
+    metrics.count("rows sketched", rows)
+    return sketches
+
+
+@metrics.timed("quantile_tiers")
+def quantile_tiers(ques, datafiles, mapper=map):
+    # Tiers for each Range question at the quintiles of its column, merged
+    # across the datafiles of every table the question comes from. Each
+    # datafile is read once, however many questions it holds.
+    sentinels = set(float(code) for code in SENTINELS)
+    columns = coll.OrderedDict((table, {}) for table in datafiles)
+    for que, k in ques.iteritems():
+        if k.range is None:
+            continue
+        excluded = set(sentinels)
+        for code in k.codes:
+            try:
+                excluded.add(float(code))
+            except ValueError:
+                pass
+        for table in k.source:
+            if table in columns:
+                column = que.lower().rstrip().split('\u0007')[0]
+                columns[table].setdefault(column, set()).update(excluded)
+
+    sketched = dict(zip(columns, metrics.collect_map(
+        mapper, sketch_datafile, [(datafiles[table], table_columns)
+                                  for table, table_columns
+                                  in columns.iteritems()])))
+
+    tiers = {}
+    for que, k in ques.iteritems():
+        if k.range is None:
+            continue
+        column = que.lower().rstrip().split('\u0007')[0]
+        sketch = QuantileSketch()
+        for table in k.source:
+            if column in sketched.get(table, {}):
+                sketch.merge(sketched[table][column])
+        quantiles = sketch.quantiles([x / 5.0 for x in range(0, 5)])
+        if quantiles is None:
+            log.warning("No data found for {}, so its tiers are spaced "
+                        "evenly".format(que))
+            continue
+        # Tiers must increase, so quantiles that round to the same value
+        # collapse into one
+        tiers[que] = sorted(set(int(math.ceil(q)) for q in quantiles))
+    return tiers
+
+
+class Fragments(object):
+    # The pieces of LookML a question contributes to the views. Each is the
+    # same for every value label and every view, so they're worked out once
+    # per question rather than inside the loops that write them.
+    __slots__ = ("dimension", "column", "label", "sources", "tiers")
+
+    def __init__(self, que, k, tables, tiers=None):
+        # We preserve the shortname of the question as the dimension name
+        # for easy searchability
+        self.dimension = que.lower().replace('\u0007', '_')
+        self.column = que.lower().rstrip().split('\u0007')[0]
+        # We use the question name as the label
+        self.label = (k.description.capitalize().rstrip()
+                      if k.description is not None else None)
+        # Questions that only some of the tables share check src_table
+        self.sources = None
+        if len(tables) > len(k.source):
+            self.sources = "({})".format(', '.join(
+                "'" + item + "'" for item in k.source))
+        # Tier boundaries taken from the data, if there are any
+        self.tiers = tiers
+
+
+def lookml_fragments(nested_cb, tables, tiers=None):
+    tiers = tiers or {}
+    fragments = coll.OrderedDict()
+    for dat, ques in nested_cb.iteritems():
+        fragments[dat] = coll.OrderedDict(
+            (que, Fragments(que, k, tables, tiers.get(que)))
+            for que, k in ques.iteritems())
+    return fragments
+
+
+class ViewManifest(object):
+    # Remembers what went into each view written, so that a rerun after a
+    # small change (say, another year's codebook) only renders what changed.
+    # Views are built from fragments -- a header, a dimension per question
+    # and so on -- and for each one we keep a hash of its inputs and where
+    # its text sits in the file. Fragments whose inputs hash the same are
+    # copied from the old file rather than rendered, and a view that comes
+    # out the same as before isn't written at all, so its file is untouched.
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {"questions": {}, "views": {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+        self.rendered = 0
+        self.reused = 0
+        self.unchanged = []
+        # Views may be written on separate threads
+        self.lock = threading.Lock()
+
+    def compare(self, ques):
+        # Counts the questions that are new or different since the last run
+        digests = dict((que, hashlib.md5(repr((k.content(), k.source)))
+                        .hexdigest()) for que, k in ques.iteritems())
+        previous = self.entries["questions"]
+        changed = sum(1 for que, digest in digests.iteritems()
+                      if previous.get(que) != digest)
+        removed = sum(1 for que in previous if que not in digests)
+        self.entries["questions"] = digests
+        return changed, removed
+
+    def previous(self, path):
+        # The fragments of the file as it was last written, by the hash of
+        # their inputs. If the file's gone or been edited since, there's
+        # nothing to reuse.
+        entry = self.entries["views"].get(os.path.normpath(path))
+        if entry is None or not os.path.exists(path):
+            return None, {}
+        with open(path, "rb") as f:
+            text = f.read()
+        if hashlib.md5(text).hexdigest() != entry["hash"]:
+            return None, {}
+        return entry["hash"], dict(
+            (digest, text[offset:offset + length])
+            for digest, offset, length in entry["fragments"])
+
+    def record(self, path, file_hash, fragments, rendered, written):
+        with self.lock:
+            self.entries["views"][os.path.normpath(path)] = {
+                "hash": file_hash, "fragments": fragments}
+            self.rendered += rendered
+            self.reused += len(fragments) - rendered
+            if not written:
+                self.unchanged.append(os.path.normpath(path))
+
+    def save(self):
+        # Write to a temporary file first so an interrupted run can't leave
+        # a truncated manifest behind
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.entries, f)
+        os.rename(self.path + ".tmp", self.path)
+
+
+@metrics.timed("write_view")
+def write_view(path, chunks, manifest=None, buffer_size=1 << 20):
+    # Views come in as (inputs, render) pairs, one per fragment, where
+    # render is called to produce the fragment's text. They're assembled in
+    # memory and written a megabyte at a time, rather than a line at a time.
+    if manifest is None:
+        with open(path, "w") as lookml:
+            buffered, size = [], 0
+            for inputs, render in chunks:
+                buffered.append(render())
+                size += len(buffered[-1])
+                if size >= buffer_size:
+                    lookml.write("".join(buffered))
+                    buffered, size = [], 0
+            lookml.write("".join(buffered))
+            metrics.count("bytes written", lookml.tell())
+        metrics.count("views written")
+        return path
+
+    old_hash, previous = manifest.previous(path)
+    texts, fragments, offset, rendered = [], [], 0, 0
+    for inputs, render in chunks:
+        digest = hashlib.md5(repr(inputs)).hexdigest()
+        text = previous.get(digest)
+        if text is None:
+            text = render()
+            rendered += 1
+        texts.append(text)
+        fragments.append((digest, offset, len(text)))
+        offset += len(text)
+    text = "".join(texts)
+    file_hash = hashlib.md5(text).hexdigest()
+    written = file_hash != old_hash
+    if written:
+        with open(path, "w") as lookml:
+            lookml.write(text)
+        metrics.count("bytes written", len(text))
+        metrics.count("views written")
+    else:
+        metrics.count("views unchanged")
+    metrics.count("fragments rendered", rendered)
+    metrics.count("fragments reused", len(fragments) - rendered)
+    manifest.record(path, file_hash, fragments, rendered, written)
+    return path
+
+
+def writebaseLookMLview(nested_cb, tables, fragments=None, manifest=None,
+                        directory="."):
+    fragments = fragments or lookml_fragments(nested_cb, tables)
+    for dat, ques in nested_cb.iteritems():
+        # We name the output file after the dataset
+        file_name = re.sub(r'[/\s\-]', '_', dat)
+        write_view(os.path.join(directory, file_name + ".view.lookml"),
+                   base_view(file_name, ques, fragments[dat]), manifest)
+        return "{}.view.lookml".format(file_name)
+
+
+def base_view(file_name, ques, fragments):
+    # First we write the view definitions
+    yield file_name, functools.partial(
+        "- view: {}\n"
+        "  sql_table_name: [ENTER DATA FILE NAME HERE]\n\n\n"
+        "  fields:\n".format, file_name)
+
+    for que, k in ques.iteritems():
+        f = fragments[que]
+        # We write definitions for fields differently depending
+        # on whether it has key/value pairs or a value range
+        if (k.codes and k.range is None):
+            yield ((que, k.content(), f.sources),
+                   functools.partial(case_dimension, k, f))
+
+        # For value ranges, we split the range into 5 tiers
+        # evenly spaced between the min and max
+        elif (k.range is not None):
+            yield ((que, k.content(), f.tiers),
+                   functools.partial(tier_dimension, que, k, f))
+
+
+def case_dimension(k, f):
+    # Key/value pairs get written as string dimensions, with the topic as
+    # view_label for easy categorization
+    condition = "        ${TABLE}." + f.column + " = "
+    tail = "\n"
+    if f.sources is not None:
+        tail += "        AND ${TABLE}.src_table in " + f.sources + "\n"
+    chunk = ["  - dimension: {}\n"
+             "    label: \"{}\"\n"
+             "    view_label: Cohort {}\n"
+             "    type: string\n"
+             "    sql_case:\n".format(f.dimension, f.label, k.topic)]
+    for code, label in zip(k.codes, k.labels):
+        chunk.extend(("      ", label.rstrip().replace(
+            '#', '\\#').replace(':', '":"'), ": |\n", condition, code, tail))
+    chunk.append("\n\n")
+    return "".join(chunk)
+
+
+def tier_dimension(que, k, f):
+    ends = k.range.split(':')
+    tiers = f.tiers
+    if tiers is None:
+        tiers = []
+        for x in range(0, 5):
+            tiers.append(int(math.ceil((float(ends[0]) +
+                                        x * float(ends[1]) / 4))))
+    chunk = ["  - dimension: {}\n".format(f.dimension)]
+    if (f.label is not None):
+        chunk.append("    label: \"{}\"\n".format(f.label))
+    chunk.append("    view_label: Cohort {}\n"
+                 "    type: tier\n"
+                 "    tiers: [{}]\n"
+                 "    style: classic\n"
+                 "    sql: ${{TABLE}}.{}\n"
+                 "    sql: CASE WHEN "
+                 "${{TABLE}}.{} between {} AND {} "
+                 "THEN ${{TABLE}}.{} END\n\n".format(
+                     k.topic, ",".join(str(tier) for tier in tiers), que,
+                     que.lower(), ends[0], ends[1], que.lower()))
+    return "".join(chunk)
+
+
+def writelookupLookMLview(nested_cb, tables, explore_view, fragments=None,
+                          manifest=None, directory="."):
+    # An alternative to writebaseLookMLview for large codebooks. Rather than a
+    # sql_case branch per value label, the labels go into a lookup table
+    # keyed by (question, code, src_table), and each dimension reads its
+    # label through a join to that table. The view file no longer grows
+    # with the number of labels, and a query only carries the joins for the
+    # dimensions it uses instead of their whole CASE statements.
+    fragments = fragments or lookml_fragments(nested_cb, tables)
+    for dat, ques in nested_cb.iteritems():
+        file_name = re.sub(r'[/\s\-]', '_', dat)
+        labels_name = "{}_labels".format(file_name)
+        lookml = [(file_name, functools.partial(
+            "- view: {}\n"
+            "  sql_table_name: [ENTER DATA FILE NAME HERE]\n\n\n"
+            "  fields:\n".format, file_name))]
+        if len(tables) > 1:
+            lookml.append(("src_table", functools.partial(
+                str, "  - dimension: src_table\n"
+                     "    hidden: true\n"
+                     "    sql: ${TABLE}.src_table\n\n")))
+        joins = [(explore_view, functools.partial(
+            "# Joins for the label lookup table. Add these to the "
+            "explore built on {}.\n"
+            "  joins:\n".format, explore_view))]
+        labels = [(None, functools.partial(
+            str, "question,code,src_table,position,label\n"))]
+
+        for que, k in ques.iteritems():
+            f = fragments[dat][que]
+            if (k.codes and k.range is None):
+                inputs = (que, k.content(), f.sources)
+                lookml.append((inputs, functools.partial(
+                    lookup_dimension, k, f)))
+                joins.append((inputs + (explore_view,), functools.partial(
+                    lookup_join, f, labels_name, explore_view)))
+                labels.append((inputs + (k.source,), functools.partial(
+                    lookup_labels, k, f)))
+
+            elif (k.range is not None):
+                lookml.append(((que, k.content(), f.tiers),
+                               functools.partial(tier_dimension, que, k, f)))
+        labels_path = os.path.join(directory, labels_name)
+        write_view(labels_path + ".csv", labels, manifest)
+        write_view(os.path.join(directory, file_name + ".view.lookml"),
+                   lookml, manifest)
+        write_view(labels_path + ".joins.lookml", joins, manifest)
+
+        # The lookup table itself, loaded into BigQuery from the CSV above
+        lookml = [(labels_name, functools.partial(
+            "- view: {}\n"
+            "  sql_table_name: [ENTER LABEL TABLE NAME HERE]\n\n\n"
+            "  fields:\n".format, labels_name))]
+        for field, field_type in (("question", "string"),
+                                  ("code", "number"),
+                                  ("src_table", "string"),
+                                  ("position", "number"),
+                                  ("label", "string")):
+            lookml.append((field, functools.partial(
+                "  - dimension: {0}\n"
+                "    hidden: true\n"
+                "    type: {1}\n"
+                "    sql: ${{TABLE}}.{0}\n\n".format, field, field_type)))
+        write_view(labels_path + ".view.lookml", lookml, manifest)
+        return "{}.view.lookml".format(file_name)
+
+
+def lookup_dimension(k, f):
+    # Labels sort in the order the codebook lists them, just as the
+    # branches of a sql_case do
+    return ("  - dimension: {0}\n"
+            "    label: \"{1}\"\n"
+            "    view_label: Cohort {2}\n"
+            "    type: string\n"
+            "    sql: ${{{0}_labels.label}}\n"
+            "    order_by_field: {0}_position\n\n"
+            "  - dimension: {0}_position\n"
+            "    hidden: true\n"
+            "    type: number\n"
+            "    sql: ${{{0}_labels.position}}\n\n"
+            "  - dimension: {0}_code\n"
+            "    hidden: true\n"
+            "    sql: ${{TABLE}}.{3}\n\n\n").format(
+                f.dimension, f.label, k.topic, f.column)
+
+
+def lookup_join(f, labels_name, explore_view):
+    chunk = ("  - join: {0}_labels\n"
+             "    from: {1}\n"
+             "    relationship: many_to_one\n"
+             "    sql_on: |\n"
+             "      ${{{0}_labels.question}} = '{0}'\n"
+             "      AND ${{{0}_labels.code}} = ${{{2}.{0}_code}}\n").format(
+                 f.dimension, labels_name, explore_view)
+    # Questions that only some of the tables share get a row per table,
+    # just as their sql_case branches check src_table
+    if f.sources is not None:
+        chunk += ("      AND ${{{0}_labels.src_table}} = "
+                  "${{{1}.src_table}}\n").format(f.dimension, explore_view)
+    return chunk + "\n"
+
+
+def lookup_labels(k, f):
+    chunk = StringIO()
+    rows = csv.writer(chunk, lineterminator="\n")
+    for source in (k.source if f.sources is not None else [""]):
+        rows.writerows(
+            [f.dimension, code, source, position, label.rstrip()]
+            for position, (code, label) in enumerate(zip(k.codes, k.labels)))
+    return chunk.getvalue()
+
+
+def writefilteredview(nested_cb, tables, fragments=None, manifest=None,
+                      directory="."):
+    fragments = fragments or lookml_fragments(nested_cb, tables)
+    for dat, top in nested_cb.iteritems():
+        # We name the output file after the dataset
+        file_name = re.sub(r'[/\s\-]', '_', dat)
+        write_view(os.path.join(directory, file_name + "_filters.view.lookml"),
+                   filtered_view(file_name, top, fragments[dat]), manifest)
+        return "{}_filters.view.lookml".format(file_name)
+
+
+def filtered_view(file_name, top, fragments):
+    # First we write the view definitions
+    yield file_name, functools.partial(
+        "- view: {0}_filters\n"
+        "  extends: {0}\n"
+        "  fields:\n".format, file_name)
+
+    for ques, des in top.iteritems():
+        f = fragments[ques]
+        yield (ques, des.topic, des.description), functools.partial(
+            filter_field, des, f)
+
+
+def filter_field(des, f):
+    # Every question gets a filter-only field, labelled with the question
+    # name, with the topic as view_label for easy categorization
+    return ("  - filter: select_{0}\n"
+            "    label: \"{1}\"\n"
+            "    view_label: Group {2}\n"
+            "    suggest_dimension: {0}\n\n\n").format(
+                f.dimension, f.label, des.topic)
+
+
+def writemeasures(nested_cb, tables, weighted_measures, fragments=None,
+                  manifest=None, directory="."):
+    fragments = fragments or lookml_fragments(nested_cb, tables)
+    for dat, top in nested_cb.iteritems():
+        # We name the output file after the dataset
+        file_name = re.sub(r'[/\s\-]', '_', dat)
+        write_view(os.path.join(directory,
+                                file_name + "_measures.view.lookml"),
+                   measures_view(file_name, top, fragments[dat],
+                                 weighted_measures), manifest)
+        return "{}_measures.view.lookml".format(file_name)
+
+
+def measures_view(file_name, top, fragments, weighted_measures):
+    # First we write the view definitions
+    yield file_name, functools.partial(
+        "- view: {0}_measures\n"
+        "  extends: {0}_filters\n"
+        "  fields:\n".format, file_name)
+
+    dimensions = [fragments[ques].dimension
+                  for ques, des in top.iteritems()
+                  if (des.codes or des.range is not None)]
+    for chunk in population_measures(dimensions, weighted_measures):
+        yield chunk
+
+
+def population_measures(dimensions, weighted_measures):
+    # The group is defined by every filter at once, whichever weighted
+    # measure it's counted in, so its conditions are only built once
+    conditions = group_conditions(dimensions)
+
+    for weighted_measure in weighted_measures:
+        suffix = ("_" + weighted_measure if len(weighted_measures) > 1
+                  else "")
+        yield (suffix, weighted_measure), functools.partial(
+            "  - measure: cohort_population{0}\n"
+            "    type: sum\n"
+            "    view_label: Populations\n"
+            "    value_format_name: decimal_0\n"
+            "    sql: ${{TABLE}}.{1}\n\n"
+            "  - measure: group_population{0}\n"
+            "    type: sum\n"
+            "    view_label: Populations\n"
+            "    value_format_name: decimal_0\n"
+            "    sql: |\n"
+            "      CASE WHEN\n".format, suffix, weighted_measure)
+        yield dimensions, conditions
+        yield weighted_measure, functools.partial(
+            "      THEN {}\n"
+            "      ELSE 0\n"
+            "      END\n\n\n".format, weighted_measure)
+
+
+def group_conditions(dimensions):
+    # Renders the conditions the first time they're needed and hands back
+    # the same text after that
+    text = []
+
+    def render():
+        if not text:
+            text.append("".join(
+                """      {} {{% condition select_{} %}}
+                        ${{{}}} {{%endcondition%}} \n""".format(
+                    "AND" if i > 0 else "", dimension, dimension)
+                for i, dimension in enumerate(dimensions)))
+        return text[0]
+    return render
+
+
+def rollup_questions(ques, names):
+    # The coded questions a rollup groups by, given question names or whole
+    # topics. Ranges are left out: their raw values would make the rollup
+    # nearly as big as the table it summarises.
+    chosen = []
+    for name in names:
+        matches = [que for que, k in ques.iteritems()
+                   if que.split('\u0007')[0].lower() == name.lower() or
+                   k.topic.lower() == name.lower()]
+        if not matches:
+            log.warning("No question or topic named {} to roll up "
+                        "by".format(name))
+        for que in matches:
+            if not ques[que].codes or ques[que].range is not None:
+                if que.split('\u0007')[0].lower() == name.lower():
+                    log.warning("{} is a range, so it isn't rolled "
+                                "up".format(que))
+            elif que not in chosen:
+                chosen.append(que)
+    return chosen
+
+
+def writerollups(nested_cb, tables, rollups, weighted_measures,
+                 fragments=None, manifest=None, directory="."):
+    # Population measures only ever sum weights, so a table of those sums
+    # grouped by a handful of coded dimensions answers the same queries as
+    # the person-level table for a fraction of the bytes scanned. For each
+    # rollup we write the SQL that builds its table, a view over it with
+    # the same dimensions, filters and measures as the full views, and an
+    # explore to query it through.
+    fragments = fragments or lookml_fragments(nested_cb, tables)
+    names = []
+    for dat, ques in nested_cb.iteritems():
+        file_name = re.sub(r'[/\s\-]', '_', dat)
+        for n, rollup in enumerate(rollups, 1):
+            chosen = rollup_questions(ques, rollup)
+            if not chosen:
+                continue
+            rollup_name = "{}_rollup{}".format(
+                file_name, "_{}".format(n) if len(rollups) > 1 else "")
+            rollup_path = os.path.join(directory, rollup_name)
+            write_view(rollup_path + ".sql",
+                       rollup_sql(rollup_name, tables, chosen, fragments[dat],
+                                  weighted_measures), manifest)
+            write_view(rollup_path + ".view.lookml",
+                       rollup_view(rollup_name, ques, chosen, fragments[dat],
+                                   weighted_measures), manifest)
+            write_view(rollup_path + ".explore.lookml",
+                       [(chosen, functools.partial(
+                           rollup_explore, rollup_name, chosen,
+                           fragments[dat]))], manifest)
+            names.append(rollup_name)
+        return names
+
+
+def rollup_sql(rollup_name, tables, chosen, fragments, weighted_measures):
+    # Tables that only some questions come from are told apart by
+    # src_table, so the rollup keeps it whenever there's more than one.
+    # A question split between codebooks is two dimensions on one column.
+    columns = ["src_table"] if len(tables) > 1 else []
+    for que in chosen:
+        if fragments[que].column not in columns:
+            columns.append(fragments[que].column)
+    sums = ["SUM({0}) AS {0}".format(weighted_measure)
+            for weighted_measure in weighted_measures]
+    yield (rollup_name, columns, weighted_measures), functools.partial(
+        "-- Weighted rollup of the census table. Save the results as a "
+        "table and\n"
+        "-- enter its name in {0}.view.lookml\n"
+        "SELECT\n"
+        "  {1}\n"
+        "FROM [ENTER DATA FILE NAME HERE]\n"
+        "GROUP BY {2}\n".format, rollup_name, ",\n  ".join(columns + sums),
+        ", ".join(columns))
+
+
+def rollup_view(rollup_name, ques, chosen, fragments, weighted_measures):
+    yield rollup_name, functools.partial(
+        "- view: {}\n"
+        "  sql_table_name: [ENTER ROLLUP TABLE NAME HERE]\n\n\n"
+        "  fields:\n".format, rollup_name)
+
+    # Dimensions are written out in full rather than as lookups, since the
+    # rollup is small enough that its sql_case costs nothing
+    for que in chosen:
+        yield ((que, ques[que].content(), fragments[que].sources),
+               functools.partial(case_dimension, ques[que], fragments[que]))
+    for que in chosen:
+        yield ((que, ques[que].topic, ques[que].description),
+               functools.partial(filter_field, ques[que], fragments[que]))
+    for chunk in population_measures(
+            [fragments[que].dimension for que in chosen], weighted_measures):
+        yield chunk
+
+
+def rollup_explore(rollup_name, chosen, fragments):
+    return ("# Add this to your model. Population queries that only use "
+            "these dimensions\n"
+            "# can run against {0} instead of the full table:\n"
+            "#   {1}\n"
+            "- explore: {0}\n").format(
+                rollup_name,
+                ", ".join(fragments[que].dimension for que in chosen))
+
+
+def write_lookml(writer):
+    function, args = writer
+    return function(*args)
+
+
+@metrics.timed("render_views")
+def render_views(merged, tables, measures=(), directory=".", layout="case",
+                 dataset="census", tiers=None, rollups=None, manifest=None,
+                 threads=False):
+    # Write the LookML for a merged codebook into directory: the base view
+    # (with its label lookup table if layout is "lookup"), the filters
+    # view, the measures view if there are weighted measures, and any
+    # rollups. Returns the names of what was written by view.
+    if rollups and not measures:
+        raise ValueError("Rollups sum the weighted measures, so they need "
+                         "at least one")
+    nested_cb = coll.OrderedDict([(dataset, merged)])
+    # Names, labels and src_table checks are shared by all the views, so
+    # they're worked out once up front
+    fragments = lookml_fragments(nested_cb, tables, tiers)
+    views = ["codebook", "filters"]
+    if layout == "lookup":
+        # Label joins belong to the explore on the last view in the chain
+        explore_view = re.sub(r'[/\s\-]', '_', dataset) + (
+            "_measures" if measures else "_filters")
+        writers = [(writelookupLookMLview, (nested_cb, tables, explore_view,
+                                            fragments, manifest, directory))]
+    else:
+        writers = [(writebaseLookMLview, (nested_cb, tables, fragments,
+                                          manifest, directory))]
+    writers.append((writefilteredview, (nested_cb, tables, fragments,
+                                        manifest, directory)))
+    if len(measures) > 0:
+        views.append("measures")
+        writers.append((writemeasures, (nested_cb, tables, measures,
+                                        fragments, manifest, directory)))
+
+    # The views don't depend on each other, so they can be written at the
+    # same time. Rendering holds the GIL, so this only pays off when the
+    # writes themselves are slow (e.g. on a network drive).
+    if threads:
+        pool = ThreadPool(len(writers))
+        names = pool.map(write_lookml, writers)
+        pool.close()
+        pool.join()
+    else:
+        names = map(write_lookml, writers)
+    names = coll.OrderedDict(zip(views, names))
+
+    if rollups:
+        names["rollups"] = writerollups(nested_cb, tables, rollups, measures,
+                                        fragments, manifest, directory)
+    return names
+
+
+# The views refer to the columns of the underlying table as ${TABLE}.column
+table_column_re = re.compile(r'\$\{TABLE\}\.(\w+)')
+
+
+def referenced_columns(paths):
+    # The columns of the underlying table that a set of LookML files use,
+    # lowercased since BigQuery doesn't tell column names apart by case
+    columns = set()
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                columns.update(name.lower()
+                               for name in table_column_re.findall(line))
+    return columns
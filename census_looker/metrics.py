@@ -0,0 +1,183 @@
+# Timers and counters for the stages of a run (scanning datafiles, parsing
+# and merging codebooks, writing views), so a slow nightly run shows where
+# its time went. Nothing is recorded until enable() is called, and only
+# whole stages are timed (a file, a codebook, a view) rather than rows or
+# lines, so leaving it on in production costs next to nothing.
+
+import atexit
+import collections as coll
+import cProfile
+import functools
+import json
+import logging
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Windows has no getrusage, so peak memory goes unreported there
+    resource = None
+
+
+log = logging.getLogger(__name__)
+
+enabled = False
+started = None
+timers = coll.OrderedDict()
+counters = coll.OrderedDict()
+# Views can be written on several threads at once
+lock = threading.Lock()
+
+
+def enable():
+    global enabled, started
+    enabled = True
+    started = time.time()
+
+
+def count(name, n=1):
+    if enabled:
+        with lock:
+            counters[name] = counters.get(name, 0) + n
+
+
+def peak_rss_mb(who="self"):
+    # ru_maxrss is in kilobytes on Linux
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == "self"
+                               else resource.RUSAGE_CHILDREN)
+    return usage.ru_maxrss / 1024.0
+
+
+class Timer(object):
+    # Adds the time spent in a with block to its stage, along with how many
+    # times the stage ran and the peak memory of the process once it's done,
+    # which shows the stage that raised it
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        add_time(self.stage, time.time() - self.start, 1, peak_rss_mb())
+
+
+class NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def timer(stage):
+    return Timer(stage) if enabled else NULL_TIMER
+
+
+def timed(stage):
+    # Decorates a function to time every call to it as a stage
+    def decorate(func):
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return timed_func
+    return decorate
+
+
+def add_time(stage, seconds, calls, rss):
+    with lock:
+        entry = timers.get(stage)
+        if entry is None:
+            entry = timers[stage] = coll.OrderedDict(
+                [("seconds", 0.0), ("calls", 0), ("peak_rss_mb", None)])
+        entry["seconds"] += seconds
+        entry["calls"] += calls
+        entry["peak_rss_mb"] = max(entry["peak_rss_mb"], rss)
+
+
+def absorb(recorded):
+    # Add the timers and counters recorded somewhere else (such as a worker
+    # process) to our own
+    worker_timers, worker_counters = recorded
+    for stage, entry in worker_timers.iteritems():
+        add_time(stage, entry["seconds"], entry["calls"],
+                 entry["peak_rss_mb"])
+    for name, n in worker_counters.iteritems():
+        count(name, n)
+
+
+class Collected(object):
+    # Runs a function with a fresh set of metrics and hands back what it
+    # recorded along with its result. Worker processes don't share our
+    # metrics, so this is how theirs make it back. It's pickled along with
+    # the function, which has to live at the module level.
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, arg):
+        global enabled, timers, counters
+        saved = enabled, timers, counters
+        enabled, timers, counters = True, coll.OrderedDict(), \
+            coll.OrderedDict()
+        try:
+            return self.func(arg), (timers, counters)
+        finally:
+            enabled, timers, counters = saved
+
+
+def collect_map(mapper, func, items):
+    # mapper(func, items), keeping the metrics recorded by func even when
+    # mapper runs it in other processes
+    if not enabled:
+        return mapper(func, items)
+    results = []
+    for result, recorded in mapper(Collected(func), items):
+        absorb(recorded)
+        results.append(result)
+    return results
+
+
+def snapshot():
+    return coll.OrderedDict([
+        ("started", started),
+        ("seconds", time.time() - started if started else None),
+        ("peak_rss_mb", peak_rss_mb()),
+        ("peak_rss_workers_mb", peak_rss_mb("children")),
+        ("timers", timers),
+        ("counters", counters)])
+
+
+def dump(path):
+    with open(path, "w") as f:
+        json.dump(snapshot(), f, indent=2)
+    log.info("Metrics written to {}".format(path))
+
+
+def dump_profile(profiler, path):
+    profiler.disable()
+    profiler.dump_stats(path)
+    log.info("Profile written to {} (read it with pstats)".format(path))
+
+
+def instrument(metrics_file=None, profile_file=None):
+    # Called by the scripts before they start work. The metrics and the
+    # profile are written when the script exits, however it exits.
+    if metrics_file:
+        enable()
+        atexit.register(dump, metrics_file)
+    if profile_file:
+        profiler = cProfile.Profile()
+        atexit.register(dump_profile, profiler, profile_file)
+        profiler.enable()
@@ -0,0 +1,872 @@
+# Inferring BigQuery schemas for DataFerrett datafiles: sampling or streaming
+# every row through the type lattice, profiling columns, caching results
+# between runs and building the query that unions several files together.
+
+import base64
+import bz2
+import collections as coll
+import csv
+import gzip
+import hashlib
+from itertools import islice
+import json
+import logging
+import math
+import os
+import random
+import re
+import struct
+import time
+import zipfile
+import zlib
+
+from census_looker import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+# BigQuery types form a simple lattice: every INTEGER is a valid FLOAT and
+# every FLOAT is a valid STRING, so a column's type only ever widens
+TYPE_ORDER = ("INTEGER", "FLOAT", "STRING")
+INTEGER, FLOAT, STRING = range(len(TYPE_ORDER))
+
+# Codes DataFerrett uses for "not in universe", "no answer" and the like,
+# which would otherwise distort a column's range
+SENTINELS = ("-1", "-9", "21474836.47")
+
+# INTEGERs in BigQuery (and longs in Avro) are signed 64-bit, so whole
+# numbers at least this large have to be FLOATs
+INTEGER_LIMIT = 2.0 ** 63
+
+# How many rows near the top of a datafile are sampled for its types
+SAMPLE_ROWS = 10
+
+
+# DataFerrett downloads and our archives come compressed in a few formats.
+# We recognise them by their leading magic bytes rather than trusting the
+# file extension.
+CODECS = (("gzip", "\x1f\x8b"), ("bz2", "BZh"), ("zip", "PK\x03\x04"))
+
+
+def detect_codec(datafile):
+    with open(datafile, "rb") as f:
+        magic = f.read(4)
+    for codec, prefix in CODECS:
+        if magic.startswith(prefix):
+            return codec
+    return None
+
+
+class ZipMember(object):
+    # One file inside a zip archive, which closes the archive along with
+    # itself. Otherwise each zip datafile we read would leave a file handle
+    # open until the archive happened to be garbage collected.
+
+    def __init__(self, archive, name):
+        self.archive = archive
+        self.member = archive.open(name)
+
+    def read(self, *args):
+        return self.member.read(*args)
+
+    def close(self):
+        self.member.close()
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_datafile(datafile):
+    # Return a file-like object that yields the datafile's uncompressed
+    # bytes, decompressing on the fly so nothing is written to disk
+    codec = detect_codec(datafile)
+    if codec == "gzip":
+        return gzip.GzipFile(datafile, "rb")
+    elif codec == "bz2":
+        return bz2.BZ2File(datafile, "rb")
+    elif codec == "zip":
+        archive = zipfile.ZipFile(datafile)
+        # DataFerrett zips can hold the codebook alongside the data, so we
+        # prefer the first CSV in the archive
+        names = archive.namelist()
+        csvs = [n for n in names if n.lower().endswith(".csv")]
+        return ZipMember(archive, (csvs or names)[0])
+    return open(datafile, "rb")
+
+
+def iter_lines(f, block_size=1 << 20):
+    # Split a stream into lines by reading it in large blocks. The readline
+    # methods of the decompressing readers run in Python, so this is much
+    # faster than iterating over them directly.
+    remainder = ""
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        lines = (remainder + block).split("\n")
+        remainder = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if remainder:
+        yield remainder
+
+
+@metrics.timed("get_types")
+def get_types(datafile):
+    with open_datafile(datafile) as csvfile:
+        reader = csv.reader(iter_lines(csvfile), delimiter=',')
+
+        # The names of the columns should be contained in the first row of
+        # the data file
+        header_row = next(reader)
+        # Since the order of the columns matters, we'll use an OrderedDict
+        # to store the schema
+        schema = coll.OrderedDict()
+        # To begin, we'll set the type for all columns to integer and then
+        # work through the data to correct that assumption where it's
+        # incorrect
+        for c in header_row:
+            schema[c] = "INTEGER"
+
+        # We'll sample 100 random rows in the first 10,000 rows to check
+        # whether the columns really are ints
+        sample_rows = random.sample(range(100), SAMPLE_ROWS)
+
+        for r in sample_rows:
+            # Skip forward in the file r rows
+            sample_row = next(islice(reader, r, r+1))
+            # Check each column in the row
+            for c in range(len(header_row)):
+                # If the column is already a string in our schema, no need
+                # to check it (since that is the least restrictive type)
+                if not schema[header_row[c]] == "STRING":
+                    # We'll try to cast the value to a Python float
+                    try:
+                        val = float(sample_row[c])
+                        if (not val.is_integer() or
+                                abs(val) >= INTEGER_LIMIT):
+                            schema[header_row[c]] = "FLOAT"
+                    # If the casting fails, it's because there's a non-digit
+                    # in the value and so we should designate that column as
+                    # a string
+                    except ValueError:
+                        schema[header_row[c]] = "STRING"
+                    # If we succeed at casting the value, then we check whether
+                    # it's an int. If not, we change the type to float in the
+                    # schema. If it is an integer, we leave the type as int
+                    # in the schema.
+    metrics.count("rows sampled", len(sample_rows))
+    return schema
+
+
+# Whole columns can be classified at once by joining a chunk of their values
+# into one buffer and matching it against a single regex, which is much
+# cheaper than calling float() on every cell. The patterns are deliberately
+# narrow (bounded digit counts) so that anything they accept gets exactly the
+# type the per-cell float() check would give it; anything else falls back to
+# that check.
+integer_column_re = re.compile(r'(?:-?\d{1,18}\n)*-?\d{1,18}\Z')
+decimal_column_re = re.compile(
+    r'(?:-?(?:\d{1,9}(?:\.\d{0,6})?|\.\d{1,6})\n)*'
+    r'-?(?:\d{1,9}(?:\.\d{0,6})?|\.\d{1,6})\Z')
+# A decimal with a non-zero digit after the point can't be an integer
+fraction_re = re.compile(r'\.\d*[1-9]')
+
+
+def classify_column(current, values):
+    buf = "\n".join(values)
+    if integer_column_re.match(buf):
+        return current
+    if decimal_column_re.match(buf):
+        if current == FLOAT or fraction_re.search(buf):
+            return FLOAT
+        return current
+    return widen_column(current, values)
+
+
+def widen_column(current, values):
+    # Widen the type index of a column until it covers every value, giving up
+    # early once the column reaches STRING
+    for value in values:
+        try:
+            number = float(value)
+            if not number.is_integer() or abs(number) >= INTEGER_LIMIT:
+                current = FLOAT
+        except ValueError:
+            return STRING
+    return current
+
+
+def scan_rows(reader, types, chunk_size=10000, classify=classify_column,
+              stats=None):
+    # Columns that have already widened to STRING are dropped from the
+    # active list, so the work per row shrinks as the scan goes on
+    active = [c for c in range(len(types)) if types[c] != STRING]
+    # Rows counts the rows scanned, and lines every row read, blank or not,
+    # which is how rows are numbered when one has the wrong width
+    rows, lines = 0, 0
+    width = len(types)
+
+    # Reading a fixed number of rows at a time keeps memory bounded no
+    # matter how large the file is. Statistics need every row, so when
+    # we're collecting them the scan can't stop early.
+    while active or stats:
+        chunk = list(islice(reader, chunk_size))
+        if not chunk:
+            break
+        # zip would quietly cut every column down to the shortest row, so
+        # rows of the wrong width are caught first. Blank lines are just
+        # skipped.
+        widths = set(map(len, chunk))
+        if widths != set([width]):
+            for r, row in enumerate(chunk, lines + 1):
+                if row and len(row) != width:
+                    raise ValueError("Row {} has {} fields, but the header "
+                                     "has {}".format(r, len(row), width))
+            lines += len(chunk)
+            chunk = [row for row in chunk if row]
+            if not chunk:
+                continue
+        else:
+            lines += len(chunk)
+        rows += len(chunk)
+        columns = zip(*chunk)
+        for c in active:
+            types[c] = classify(types[c], columns[c])
+        active = [c for c in active if types[c] != STRING]
+        if stats:
+            for column_stats, column in zip(stats, columns):
+                column_stats.update(column)
+    return types, rows
+
+
+class HyperLogLog(object):
+    # A fixed-size sketch of the number of distinct values in a column. Two
+    # sketches of different parts of a file merge into a sketch of the whole
+    # by taking the larger of each pair of registers, which is what lets
+    # shards and separate runs be combined.
+
+    def __init__(self, precision=10, registers=None):
+        self.precision = precision
+        self.registers = registers or bytearray(1 << precision)
+
+    def add(self, value):
+        # md5 rather than hash() so the sketch is the same in every process
+        x = struct.unpack(">Q", hashlib.md5(value).digest()[:8])[0]
+        rest_bits = 64 - self.precision
+        rest = x & ((1 << rest_bits) - 1)
+        rank = rest_bits - rest.bit_length() + 1
+        index = x >> rest_bits
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        # Small cardinalities are estimated better by counting empty
+        # registers
+        zeros = self.registers.count("\x00")
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+
+class QuantileSketch(object):
+    # A KLL sketch of the distribution of a column's numbers, which answers
+    # quantile queries to within about 1% in a few kilobytes however many
+    # rows go into it. Values collect in a stack of compactors; when one
+    # fills up it's sorted and every other value moves up a level, where
+    # each value stands for twice as many rows. Like HyperLogLog, sketches
+    # of different files merge into a sketch of all of them.
+
+    def __init__(self, k=200, seed=0):
+        self.k = k
+        self.compactors = []
+        self.size = 0
+        # The ends of the distribution are kept exactly
+        self.min = None
+        self.max = None
+        # Which half of a compactor survives is picked at random. Seeding it
+        # means the same data always gives the same quantiles.
+        self.random = random.Random(seed)
+        self.grow()
+
+    def grow(self):
+        self.compactors.append([])
+        self.max_size = sum(self.capacity(h)
+                            for h in range(len(self.compactors)))
+
+    def capacity(self, height):
+        # Lower levels hold fewer values, shrinking by 2/3 a level
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.k * (2.0 / 3) ** depth)) + 1
+
+    def update(self, value):
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.compactors[0].append(value)
+        self.size += 1
+        if self.size >= self.max_size:
+            self.compress()
+
+    def compress(self):
+        for h in range(len(self.compactors)):
+            if len(self.compactors[h]) >= self.capacity(h):
+                if h + 1 >= len(self.compactors):
+                    self.grow()
+                items = sorted(self.compactors[h])
+                # An odd value out stays where it is
+                self.compactors[h] = [items.pop()] if len(items) % 2 else []
+                self.compactors[h + 1].extend(
+                    items[self.random.random() < 0.5::2])
+                self.size = sum(len(c) for c in self.compactors)
+                if self.size < self.max_size:
+                    break
+
+    def merge(self, other):
+        if other.min is None:
+            return
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        while len(self.compactors) < len(other.compactors):
+            self.grow()
+        for h, items in enumerate(other.compactors):
+            self.compactors[h].extend(items)
+        self.size = sum(len(c) for c in self.compactors)
+        while self.size >= self.max_size:
+            self.compress()
+
+    def quantiles(self, fractions):
+        # Values at each fraction of the way through the distribution, or
+        # None if the sketch is empty
+        weighted = sorted((value, 2 ** h)
+                          for h, items in enumerate(self.compactors)
+                          for value in items)
+        total = sum(weight for value, weight in weighted)
+        if not total:
+            return None
+        results = []
+        for fraction in fractions:
+            if fraction <= 0 or fraction >= 1:
+                results.append(self.min if fraction <= 0 else self.max)
+                continue
+            rank, seen = fraction * total, 0
+            for value, weight in weighted:
+                seen += weight
+                if seen > rank:
+                    break
+            results.append(value)
+        return results
+
+
+class ColumnStats(object):
+    # Profile of one column's values: how many there were, how many were
+    # empty or one of DataFerrett's sentinel codes, the numeric range of the
+    # rest, the narrowest type that holds every non-empty value and a sketch
+    # of the distinct values. Everything here merges, so partial profiles
+    # from shards, parallel files and cached runs can be combined.
+
+    def __init__(self, sentinels=SENTINELS):
+        self.count = 0
+        self.nulls = 0
+        self.sentinels = coll.OrderedDict((s, 0) for s in sentinels)
+        self.min = None
+        self.max = None
+        self.value_type = INTEGER
+        self.distinct = HyperLogLog()
+
+    def update(self, values):
+        self.count += len(values)
+        self.nulls += values.count("")
+        for s in self.sentinels:
+            self.sentinels[s] += values.count(s)
+        # Census columns repeat a handful of codes, so deduplicating first
+        # means the per-value work below only runs a few times per chunk
+        distinct = set(values)
+        distinct.discard("")
+        self.value_type = widen_column(self.value_type, distinct)
+        for value in distinct:
+            self.distinct.add(value)
+            if value in self.sentinels:
+                continue
+            try:
+                number = float(value)
+            except ValueError:
+                continue
+            if self.min is None or number < self.min:
+                self.min = number
+            if self.max is None or number > self.max:
+                self.max = number
+
+    def merge(self, other):
+        self.count += other.count
+        self.nulls += other.nulls
+        for s in self.sentinels:
+            self.sentinels[s] += other.sentinels.get(s, 0)
+        for number in (other.min, other.max):
+            if number is not None:
+                self.min = number if self.min is None else min(self.min,
+                                                               number)
+                self.max = number if self.max is None else max(self.max,
+                                                               number)
+        self.value_type = max(self.value_type, other.value_type)
+        self.distinct.merge(other.distinct)
+
+    def to_json(self):
+        return coll.OrderedDict([
+            ("count", self.count),
+            ("nulls", self.nulls),
+            ("sentinels", self.sentinels),
+            ("min", self.min),
+            ("max", self.max),
+            ("value_type", TYPE_ORDER[self.value_type]),
+            ("distinct", self.distinct.count()),
+            ("registers", base64.b64encode(
+                zlib.compress(str(self.distinct.registers))))])
+
+    @classmethod
+    def from_json(cls, profile):
+        stats = cls(str(s) for s in profile["sentinels"])
+        stats.count = profile["count"]
+        stats.nulls = profile["nulls"]
+        stats.sentinels.update(profile["sentinels"])
+        stats.min = profile["min"]
+        stats.max = profile["max"]
+        stats.value_type = TYPE_ORDER.index(profile["value_type"])
+        stats.distinct = HyperLogLog(registers=bytearray(
+            zlib.decompress(base64.b64decode(profile["registers"]))))
+        return stats
+
+
+def build_schema(header_row, types):
+    schema = coll.OrderedDict()
+    for c in range(len(header_row)):
+        schema[header_row[c]] = TYPE_ORDER[types[c]]
+    return schema
+
+
+def report_scan(datafile, rows, elapsed):
+    log.info("Scanned {} rows of {} in {:.1f}s ({:.0f} rows/sec)".format(
+        rows, datafile, elapsed, rows / elapsed if elapsed else 0))
+
+
+def split_datafile(datafile, shards, size=None):
+    # Break the body of a datafile into byte ranges that each start and end
+    # on a line boundary. DataFerrett extracts never quote newlines inside a
+    # field, so a line boundary is always a row boundary.
+    if size is None:
+        size = os.path.getsize(datafile)
+    with open(datafile, "rb") as csvfile:
+        header_row = next(csv.reader([csvfile.readline()]))
+        bounds = [csvfile.tell()]
+        step = (size - bounds[0]) // shards
+        for s in range(1, shards):
+            # Backing up one byte means a guess that already sits on the start
+            # of a line stays there, rather than skipping that whole line
+            csvfile.seek(max(bounds[0] + s * step, bounds[-1] + 1) - 1)
+            csvfile.readline()
+            if csvfile.tell() >= size:
+                break
+            bounds.append(csvfile.tell())
+    bounds.append(size)
+    return header_row, zip(bounds[:-1], bounds[1:])
+
+
+def read_range(csvfile, start, end):
+    # Yield the lines that make up bytes [start, end) of the file
+    csvfile.seek(start)
+    pos = start
+    while pos < end:
+        line = csvfile.readline()
+        if not line:
+            break
+        pos += len(line)
+        yield line
+
+
+def header_end(datafile):
+    # The offset of the first row after the header of a plain datafile
+    with open(datafile, "rb") as csvfile:
+        csvfile.readline()
+        return csvfile.tell()
+
+
+@metrics.timed("scan_range")
+def scan_range(job):
+    # Infer types for bytes [start, end) of a datafile, carrying on from the
+    # types already known for its columns. Compressed files can't be seeked
+    # into, so they come with no range and are read from the top. This lives
+    # at the module level so that worker processes can unpickle it. It
+    # times itself, so each file's scan rate covers only that file's ranges.
+    began = time.time()
+    datafile, types, start, end, chunk_size, sentinels = job
+    stats = None
+    if sentinels is not None:
+        stats = [ColumnStats(sentinels) for _ in types]
+    try:
+        if start is None:
+            with open_datafile(datafile) as csvfile:
+                lines = iter_lines(csvfile)
+                next(lines)
+                reader = csv.reader(lines, delimiter=',')
+                types, rows = scan_rows(reader, list(types), chunk_size,
+                                        stats=stats)
+        else:
+            with open(datafile, "rb") as csvfile:
+                reader = csv.reader(read_range(csvfile, start, end),
+                                    delimiter=',')
+                types, rows = scan_rows(reader, list(types), chunk_size,
+                                        stats=stats)
+    except ValueError as e:
+        # Rows are counted from the start of the range being scanned, which
+        # only needs pointing out if it isn't the top of the file
+        raise ValueError("{}{}: {}".format(
+            datafile, " (from byte {})".format(start)
+            if start and start != header_end(datafile) else "", e))
+    metrics.count("rows scanned", rows)
+    return types, rows, stats, time.time() - began
+
+
+@metrics.timed("stream_types")
+def stream_types(datafiles, shards, mapper, cache=None, chunk_size=10000,
+                 sentinels=None):
+    # Passing a list of sentinels (even an empty one) turns on collection of
+    # column statistics alongside the types
+    plans = []
+    for df in datafiles:
+        fingerprint = file_fingerprint(df)
+        entry = None
+        if cache:
+            entry = cache.lookup(df, fingerprint, True, sentinels)
+            metrics.count("schema cache misses" if entry is None
+                          else "schema cache hits")
+        if entry is None:
+            if fingerprint["codec"]:
+                header_row = fingerprint["header_row"]
+                ranges = [(None, None)]
+            else:
+                header_row, ranges = split_datafile(df, shards,
+                                                    fingerprint["size"])
+            types, rows = [INTEGER] * len(header_row), 0
+            stats = None
+            if sentinels is not None:
+                stats = [ColumnStats(sentinels) for _ in header_row]
+        else:
+            # Rows appended since the last run are the only ones that still
+            # need scanning, starting from the types found last time
+            header_row = entry["schema"].keys()
+            types = [TYPE_ORDER.index(t) for t in entry["schema"].values()]
+            rows = entry["rows"]
+            stats = entry.get("stats")
+            ranges = [(entry["offset"], fingerprint["size"])]
+        jobs = [(df, types, s, e, chunk_size, sentinels) for s, e in ranges
+                if s is None or s < e]
+        plans.append((df, fingerprint, header_row, types, rows, stats, jobs))
+
+    # Every range of every file goes into one batch so the pool stays busy
+    # even when the files differ in size
+    results = iter(metrics.collect_map(mapper, scan_range, [
+        job for plan in plans for job in plan[-1]]))
+
+    parsed_schemas, parsed_stats = [], []
+    for df, fingerprint, header_row, types, rows, stats, jobs in plans:
+        # Joining partial results in the type lattice is just taking the
+        # widest type each range saw for a column
+        scanned, elapsed = 0, 0.0
+        for _ in jobs:
+            (partial_types, partial_rows, partial_stats,
+             partial_elapsed) = next(results)
+            types = map(max, types, partial_types)
+            scanned += partial_rows
+            elapsed += partial_elapsed
+            if stats:
+                for column_stats, partial in zip(stats, partial_stats):
+                    column_stats.merge(partial)
+        if jobs:
+            report_scan(df, scanned, elapsed)
+        else:
+            log.info("Using cached schema for {}".format(df))
+        schema = build_schema(header_row, types)
+        if cache:
+            cache.store(df, fingerprint, schema, rows + scanned, True, stats)
+        parsed_schemas.append(schema)
+        parsed_stats.append(stats)
+    return parsed_schemas, parsed_stats
+
+
+@metrics.timed("sample_types")
+def sample_types(datafiles, mapper, cache=None):
+    fingerprints = [file_fingerprint(df) if cache else None
+                    for df in datafiles]
+    entries = [cache.lookup(df, fp, False, None) if cache else None
+               for df, fp in zip(datafiles, fingerprints)]
+    sampled = iter(metrics.collect_map(mapper, get_types, [
+        df for df, entry in zip(datafiles, entries) if entry is None]))
+
+    parsed_schemas = []
+    for df, fingerprint, entry in zip(datafiles, fingerprints, entries):
+        if entry is None:
+            schema = next(sampled)
+            if cache:
+                cache.store(df, fingerprint, schema, None, False)
+                metrics.count("schema cache misses")
+        else:
+            metrics.count("schema cache hits")
+            log.info("Using cached schema for {}".format(df))
+            schema = entry["schema"]
+        parsed_schemas.append(schema)
+    return parsed_schemas
+
+
+def hash_bytes(datafile, start, end):
+    with open(datafile, "rb") as f:
+        f.seek(start)
+        return hashlib.md5(f.read(end - start)).hexdigest()
+
+
+def file_fingerprint(datafile):
+    with open_datafile(datafile) as f:
+        header = next(iter_lines(f), "")
+    return {"size": os.path.getsize(datafile),
+            "mtime": os.path.getmtime(datafile),
+            "codec": detect_codec(datafile),
+            "header_row": next(csv.reader([header]), []),
+            "header_hash": hashlib.md5(header).hexdigest()}
+
+
+class SchemaCache(object):
+    # Remembers the schema inferred for each datafile between runs, keyed by
+    # the file's absolute path and checked against its size, modification time
+    # and a hash of its header row. For streamed schemas we also keep the byte
+    # offset the scan reached and a hash of the bytes just before it, so a
+    # file that has only had rows appended can pick up where it left off.
+
+    # How much of the file before the saved offset must be unchanged for us
+    # to trust that rows were only appended
+    TAIL_BYTES = 4096
+
+    def __init__(self, path, max_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f,
+                                         object_pairs_hook=coll.OrderedDict)
+
+    def lookup(self, datafile, fingerprint, streamed, sentinels):
+        # Statistics are only reused if they were collected with the same
+        # sentinel codes
+        entry = self.entries.get(os.path.abspath(datafile))
+        if (entry is None or
+                entry["header_hash"] != fingerprint["header_hash"] or
+                (streamed and not entry["streamed"]) or
+                (sentinels is not None and
+                 entry.get("sentinels") != list(sentinels))):
+            return None
+        unchanged = (entry["size"] == fingerprint["size"] and
+                     entry["mtime"] == fingerprint["mtime"])
+        # Byte offsets into a compressed file can't be resumed from
+        appended = (streamed and not fingerprint["codec"] and
+                    entry["offset"] < fingerprint["size"] and
+                    entry["tail_hash"] == self.tail_hash(datafile,
+                                                         entry["offset"]))
+        if not (unchanged or appended):
+            return None
+
+        entry["used"] = time.time()
+        # JSON hands strings back as unicode, but the rest of the script
+        # works with plain strings
+        result = dict(entry)
+        result["schema"] = coll.OrderedDict((str(k), str(v))
+                                            for k, v in entry["schema"])
+        result["stats"] = None
+        if sentinels is not None:
+            result["stats"] = [ColumnStats.from_json(profile)
+                               for profile in entry["stats"]]
+        return result
+
+    def store(self, datafile, fingerprint, schema, rows, streamed,
+              stats=None):
+        entry = dict(fingerprint)
+        # The schema already records the header
+        del entry["header_row"]
+        entry.update({"schema": schema.items(),
+                      "rows": rows,
+                      "streamed": streamed,
+                      "offset": fingerprint["size"],
+                      "tail_hash": self.tail_hash(datafile,
+                                                  fingerprint["size"]),
+                      "used": time.time()})
+        if stats is not None:
+            entry["sentinels"] = stats[0].sentinels.keys() if stats else []
+            entry["stats"] = [column_stats.to_json() for column_stats in stats]
+        self.entries[os.path.abspath(datafile)] = entry
+
+    def tail_hash(self, datafile, offset):
+        return hash_bytes(datafile, max(0, offset - self.TAIL_BYTES), offset)
+
+    def save(self):
+        # Evict the least recently used files once we're over the limit
+        keep = sorted(self.entries, key=lambda k: self.entries[k]["used"],
+                      reverse=True)[:self.max_entries]
+        self.entries = dict((k, self.entries[k]) for k in keep)
+        # Write to a temporary file first so an interrupted run can't leave
+        # a truncated cache behind
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.entries, f)
+        os.rename(self.path + ".tmp", self.path)
+
+
+def write_table_schemas(ps, output, table):
+    # Once we've parsed the schema, we print it to the output file in the
+    # format required by BigQuery
+    output.write("For table {}:\n".format(table))
+    output.write(", ".join([":".join([k, v]) for k, v in ps.items()]) + "\n")
+
+
+def write_table_stats(stats_file, tables, parsed_stats, schemas):
+    profiles = coll.OrderedDict()
+    for table, stats, schema in zip(tables, parsed_stats, schemas):
+        profiles[table] = coll.OrderedDict()
+        for field, column_stats in zip(schema, stats):
+            profile = column_stats.to_json()
+            # The raw sketch is only useful for merging, not for reading
+            del profile["registers"]
+            profiles[table][field] = profile
+    with open(stats_file, "w") as f:
+        json.dump(profiles, f, indent=2)
+
+
+def narrowest_types(schemas, parsed_stats):
+    # The narrowest type each column can take in the unioned table is the
+    # widest type of its non-empty values across all the files. Empty cells
+    # make the schema of a single file fall back to STRING, but they load as
+    # NULLs, so they shouldn't force the whole union to be a string.
+    narrowest = {}
+    for schema, stats in zip(schemas, parsed_stats):
+        for field, column_stats in zip(schema, stats):
+            narrowest[field] = max(narrowest.get(field, INTEGER),
+                                   column_stats.value_type)
+    return dict((k, TYPE_ORDER[v]) for k, v in narrowest.items())
+
+
+def master_fields(schemas):
+    # Every field of every schema, in the order they're first seen. The set
+    # of fields seen so far is kept alongside the list, so this is linear in
+    # the number of columns however wide the files are.
+    seen, fields = set(), []
+    for schema in schemas:
+        for field in schema:
+            if field not in seen:
+                seen.add(field)
+                fields.append(field)
+    return fields
+
+
+def select_expression(field, schema, narrowest=None):
+    # If we know the narrowest type a column can take and this table stores
+    # it differently, we cast it so every subselect agrees
+    if field in schema:
+        if narrowest and schema[field] != narrowest[field]:
+            return "{0}({1}) AS {1}".format(narrowest[field], field)
+        # If the field from the master field list is in the table, we just
+        # select it
+        return field
+    # If the field from the master field list is not in the table, we pad
+    # that column with a NULL so that each subselect has the same width
+    return "NULL AS {} ".format(field)
+
+
+def produce_subselect(mfl, schema, tbl_name, narrowest=None):
+    # When working with multiple files, we have field lists that need merging
+    # We'll create a subselect for each table that was passed in.
+    field_list = [select_expression(field, schema, narrowest)
+                  for field in mfl]
+    subselect = "(SELECT " + ", ".join(field_list)
+    subselect += ", " + "'" + tbl_name + "'" + " as src_table"
+    subselect += " FROM " + tbl_name + ")"
+
+    return subselect
+
+
+def write_union(output, mfl, schemas, tables, narrowest=None):
+    # The query that unions every table, written out a subselect at a time
+    # rather than built up as one string
+    output.write("SELECT * FROM ")
+    for i, (schema, table) in enumerate(zip(schemas, tables)):
+        if i:
+            output.write(", \n")
+        output.write(produce_subselect(mfl, schema, table, narrowest))
+
+
+# BigQuery's limits on a legacy SQL query: the columns its result can have
+# and the length of its text
+MAX_COLUMNS = 10000
+MAX_QUERY_BYTES = 256 * 1024
+
+
+def column_groups(mfl, schemas, tables, narrowest=None, keys=(),
+                  max_columns=MAX_COLUMNS, max_bytes=MAX_QUERY_BYTES):
+    # Split the master field list into groups small enough that the union
+    # query over each one stays within BigQuery's limits. When the union has
+    # to be split, every group starts with the key columns, so the views over
+    # the groups can be joined back together; a union that fits in one query
+    # keeps its columns in their original order. Each field's share of the
+    # query is worked out once, across all the tables, so this is linear in
+    # the number of columns.
+    def cost(field):
+        return sum(len(select_expression(field, schema, narrowest)) + 2
+                   for schema in schemas)
+
+    keys = list(keys)
+    base = len("SELECT * FROM ") + sum(
+        len(produce_subselect([], schema, table)) + 3
+        for schema, table in zip(schemas, tables))
+    base += sum(cost(field) for field in keys)
+    # src_table is a column of every group too
+    width = max_columns - len(keys) - 1
+    key_set = set(keys)
+    groups, group, size = [], [], base
+    for field in mfl:
+        if field in key_set:
+            continue
+        field_cost = cost(field)
+        if group and (len(group) >= width or size + field_cost > max_bytes):
+            groups.append(keys + group)
+            group, size = [], base
+        group.append(field)
+        size += field_cost
+    if group or not groups:
+        groups.append(keys + group)
+    if base + max([cost(group[len(keys)]) for group in groups
+                   if len(group) > len(keys)] or [0]) > max_bytes:
+        log.warning("Some column groups are still over {} bytes with only "
+                    "the key columns and one other".format(max_bytes))
+    if len(groups) == 1:
+        return [list(mfl)]
+    return groups
+
+
+def infer_schema(datafile, stream=False, shards=1, chunk_size=10000,
+                 cache=None):
+    # The schema of a single datafile, as an OrderedDict of column names and
+    # BigQuery types. Sampling only reads the top of the file; streaming (or
+    # splitting it into shards) reads every row. Pass a SchemaCache to reuse
+    # what's known about files seen before.
+    if stream or shards > 1:
+        return stream_types([datafile], shards, map, cache, chunk_size)[0][0]
+    return sample_types([datafile], map, cache)[0]
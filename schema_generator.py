@@ -1,10 +1,19 @@
 #!/usr/bin/python
 
 import argparse
-import collections as coll
-import csv
-from itertools import islice
-import random
+import logging
+import multiprocessing
+import sys
+
+from census_looker import metrics
+from census_looker.avro import write_avro
+from census_looker.lookml import referenced_columns
+from census_looker.schema import (MAX_COLUMNS, MAX_QUERY_BYTES, SENTINELS,
+                                  TYPE_ORDER, SchemaCache, column_groups,
+                                  master_fields, narrowest_types,
+                                  sample_types, stream_types,
+                                  write_table_schemas, write_table_stats,
+                                  write_union)
 
 
 # Parse the arguments passed in at the command line
@@ -16,114 +25,151 @@ parser = argparse.ArgumentParser(description='This script samples a '
                                  'in BigQuery')
 parser.add_argument('-f', '--file_loc', help='Datafile Location(s)', nargs='+')
 parser.add_argument('-t', '--table_name', help='Table Location(s)', nargs='+')
-args = parser.parse_args()
-
-
-datafiles = args.file_loc
-tables = args.table_name
-
-
-def get_types(datafile):
-    with open(datafile, "rb") as csvfile:
-        reader = csv.reader(csvfile, delimiter=',')
-
-        # The names of the columns should be contained in the first row of
-        # the data file
-        header_row = next(reader)
-        # Since the order of the columns matters, we'll use an OrderedDict
-        # to store the schema
-        schema = coll.OrderedDict()
-        # To begin, we'll set the type for all columns to integer and then
-        # work through the data to correct that assumption where it's
-        # incorrect
-        for c in header_row:
-            schema[c] = "INTEGER"
-
-        # We'll sample 100 random rows in the first 10,000 rows to check
-        # whether the columns really are ints
-        sample_rows = random.sample(range(100), 10)
-
-        for r in sample_rows:
-            # Skip forward in the file r rows
-            sample_row = next(islice(reader, r, r+1))
-            # Check each column in the row
-            for c in range(len(header_row)):
-                # If the column is already a string in our schema, no need
-                # to check it (since that is the least restrictive type)
-                if not schema[header_row[c]] == "STRING":
-                    # We'll try to cast the value to a Python float
-                    try:
-                        val = float(sample_row[c])
-                        if not val.is_integer():
-                            schema[header_row[c]] = "FLOAT"
-                    # If the casting fails, it's because there's a non-digit
-                    # in the value and so we should designate that column as
-                    # a string
-                    except ValueError:
-                        schema[header_row[c]] = "STRING"
-                    # If we succeed at casting the value, then we check whether
-                    # it's an int. If not, we change the type to float in the
-                    # schema. If it is an integer, we leave the type as int
-                    # in the schema.
-    return schema
-
-
-def write_table_schemas(ps, output, df, dfs):
-    # Once we've parsed the schema, we print it to the output file in the
-    # format required by BigQuery
-    output.write("For table {}:\n".format(tables[dfs.index(df)]))
-    output.write(", ".join([":".join([k, v]) for k, v in ps.items()]) + "\n")
-
-
-def produce_subselect(mfl, schema, tbl_name):
-    field_list = []
-    # When working with multiple files, we have field lists that need merging
-    # We'll create a subselect for each table that was passed in.
-    for field in mfl:
-        # If the field from the master field list is in the table, we just
-        # select it
-        if field in set(schema):
-            field_list.append(field)
-        # If the field from the master field list is not in the table, we
-        # pad that column with a NULL so that each subselect has the same
-        # width
-        else:
-            field_list.append("NULL AS {} ".format(field))
-    subselect = "(SELECT " + ", ".join([field for field in field_list])
-    subselect += ", " + "'" + tbl_name + "'" + " as src_table"
-    subselect += " FROM " + tbl_name + ")"
-
-    return subselect
-
-
-def main():
+parser.add_argument('-s', '--stream', help='Scan every row of each datafile '
+                    'instead of sampling', action='store_true')
+parser.add_argument('-c', '--chunk_size', help='Rows held in memory at once '
+                    'when streaming', type=int, default=10000)
+parser.add_argument('-j', '--jobs', help='Number of datafiles to examine in '
+                    'parallel', type=int, default=1)
+parser.add_argument('--shards', help='Split each datafile into this many '
+                    'byte ranges and scan them separately (implies --stream)',
+                    type=int, default=1)
+parser.add_argument('--cache', help='File to remember inferred schemas in '
+                    'between runs')
+parser.add_argument('--cache_size', help='Maximum number of datafiles to '
+                    'remember in the cache', type=int, default=1000)
+parser.add_argument('--stats', help='File to write per-column statistics to '
+                    '(implies --stream)')
+parser.add_argument('--sentinels', help='Values counted separately from the '
+                    'range of a column in the statistics (defaults to '
+                    'DataFerrett\'s usual codes)', nargs='*')
+parser.add_argument('--avro', help='Also write the rows of every datafile, '
+                    'typed and unioned, to this Avro file for loading into '
+                    'BigQuery (implies --stream)')
+parser.add_argument('--columns_from', help='LookML files (such as the views '
+                    'written by codebook_parser.py) to take the columns of '
+                    'the unioned table from, leaving out any they don\'t '
+                    'use', nargs='+')
+parser.add_argument('--key_columns', help='Columns that identify a row, kept '
+                    'in every column group so the groups can be joined back '
+                    'together', nargs='+', default=[])
+parser.add_argument('--max_columns', help='Most columns in one union query '
+                    '(BigQuery allows 10,000); wider unions are split into '
+                    'column groups', type=int, default=MAX_COLUMNS)
+parser.add_argument('--max_query_bytes', help='Longest union query to write '
+                    '(BigQuery allows 256 KB of legacy SQL); longer unions '
+                    'are split into column groups', type=int,
+                    default=MAX_QUERY_BYTES)
+parser.add_argument('--metrics', help='File to write the time spent in each '
+                    'stage, counts of what was processed and peak memory to, '
+                    'as JSON, when the script exits')
+parser.add_argument('--profile', help='File to write a cProfile profile of '
+                    'the main process to, for reading with pstats')
+
+
+def main(args):
+    datafiles, tables = args.file_loc, args.table_name
     # Make sure there are the same number of files and table names
     if not len(args.file_loc) == len(args.table_name):
         print "Mismatch between number of files and table names provided"
         exit()
 
     output_file = open("schema_output.txt", "w")
-    schemas, master_field_list, subselect_list = [], [], []
-
-    for df in datafiles:
-        parsed_schema = get_types(df)
+    schemas = []
+
+    # The datafiles are independent of each other, so they can be examined in
+    # separate processes. Pool.map hands the results back in the order the
+    # files were given, which keeps the master field list deterministic.
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    mapper = pool.map if pool else map
+    cache = SchemaCache(args.cache, args.cache_size) if args.cache else None
+    sentinels = None
+    if args.stats:
+        sentinels = SENTINELS if args.sentinels is None else args.sentinels
+    # A sampled type could be too narrow for some of the rows we'd write to
+    # Avro, so writing it needs a full scan
+    if args.stream or args.shards > 1 or args.stats or args.avro:
+        parsed_schemas, parsed_stats = stream_types(
+            datafiles, args.shards, mapper, cache, args.chunk_size, sentinels)
+    else:
+        parsed_schemas = sample_types(datafiles, mapper, cache)
+    if pool:
+        pool.close()
+        pool.join()
+    if cache:
+        cache.save()
+
+    for table, parsed_schema in zip(tables, parsed_schemas):
         schemas.append(parsed_schema)
-        for field in parsed_schema:
-            if field not in set(master_field_list):
-                master_field_list.append(field)
-        write_table_schemas(parsed_schema, output_file, df, datafiles)
+        write_table_schemas(parsed_schema, output_file, table)
+    master_field_list = master_fields(schemas)
+
+    missing = set(args.key_columns) - set(master_field_list)
+    if missing:
+        parser.error("Key columns not in any datafile: {}".format(
+            ", ".join(sorted(missing))))
+    # Columns the views never refer to only make the unioned table more
+    # expensive to scan
+    if args.columns_from:
+        referenced = referenced_columns(args.columns_from)
+        keys = set(args.key_columns)
+        union_fields = [field for field in master_field_list
+                        if field.lower() in referenced or field in keys]
+        print "Unioning the {} of {} columns the LookML uses".format(
+            len(union_fields), len(master_field_list))
+        master_field_list = union_fields
+
+    narrowest = None
+    if args.stats:
+        write_table_stats(args.stats, tables, parsed_stats, schemas)
+        narrowest = narrowest_types(schemas, parsed_stats)
+
+    if args.avro:
+        # Without statistics, the widest type any file gives a column is the
+        # only type we know holds all of its values
+        field_types = narrowest
+        if field_types is None:
+            field_types = {}
+            for schema in schemas:
+                for field, t in schema.items():
+                    field_types[field] = max(field_types.get(field, t), t,
+                                             key=TYPE_ORDER.index)
+        write_avro(args.avro, datafiles, tables, master_field_list,
+                   field_types, args.chunk_size)
 
     if len(tables) > 1:
-        for schema in schemas:
-            ss = produce_subselect(master_field_list, schema,
-                                   tables[schemas.index(schema)])
-
-            subselect_list.append(ss)
-        output_file.write("\nFor creating final unioned table:\n")
-        output_file.write("SELECT * FROM " + ", \n".join([subsel
-                                                         for subsel in
-                                                         subselect_list]))
+        with metrics.timer("write_union"):
+            groups = column_groups(master_field_list, schemas, tables,
+                                   narrowest, args.key_columns,
+                                   args.max_columns, args.max_query_bytes)
+            if len(groups) == 1:
+                output_file.write("\nFor creating final unioned table:\n")
+                write_union(output_file, groups[0], schemas, tables,
+                            narrowest)
+            else:
+                # A union too wide for one query is written as one query
+                # per group of columns, each to be saved as its own view
+                for i, group in enumerate(groups, 1):
+                    output_file.write("\n" if i == 1 else "\n\n")
+                    output_file.write(
+                        "For creating column group {} of {} ({} to {}):\n"
+                        .format(i, len(groups), group[len(args.key_columns)],
+                                group[-1]))
+                    write_union(output_file, group, schemas, tables,
+                                narrowest)
+        if len(groups) > 1:
+            print "The unioned table is too wide for one query, so it's " \
+                "split into {} column groups".format(len(groups))
+            if not args.key_columns:
+                print "Pass --key_columns to keep the columns that " \
+                    "identify a row in every group, so they can be joined"
     output_file.close()
 
 
-main()
+if __name__ == '__main__':
+    # The library reports its progress through logging
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format="%(message)s")
+    args = parser.parse_args()
+    metrics.instrument(args.metrics, args.profile)
+    main(args)